@@ -0,0 +1,212 @@
+import time
+import logging
+import threading
+from django.core.cache import caches
+from course.models import Course
+from elect_system.settings import CATALOGUE_CACHE, CATALOGUE_LOCAL_TTL
+
+'''
+课程目录的读缓存
+
+课程的元数据（名称、学分、教师、地点、院系、上课时间等）只会被教务的课程增删改接口修改，
+这里把每门课程序列化后的记录缓存在进程内存中，查询、课表和课程详情都从缓存读取。
+选课人数等计数器变化频繁，不放在缓存中。
+
+settings.CATALOGUE_CACHE为None时只使用进程内缓存，只适用于单个worker：教务的修改只会使处理该请求的
+进程失效，其他进程最多在CATALOGUE_LOCAL_TTL秒后丢弃整个进程内缓存并重新读取。
+部署多个worker时应设置为django缓存的别名
+（例如同一台机器上各worker共享的FileBasedCache），记录和版本号通过该缓存在进程间共享：
+    catalogue:version：全局版本号，每次失效加一
+    catalogue:change:<v>：版本v失效的课程id列表，两次失效拿到同一个版本号时为RESET，读到的进程丢弃全部记录
+    catalogue:record:<crsId>：课程记录
+每次读取时先比较全局版本号，只丢弃其他进程修改过的课程。
+'''
+
+VERSION_KEY = 'catalogue:version'
+CHANGE_KEY = 'catalogue:change:{}'
+RECORD_KEY = 'catalogue:record:{}'
+# Changes older than this are dropped from the shared cache, a process that
+# falls further behind clears its whole local copy instead
+CHANGE_TTL = 3600
+RECORD_TTL = 3600
+MAX_CHANGE_REPLAY = 1000
+# Change list meaning every course, written when two invalidations got the same version
+RESET = '*'
+
+
+def loadRecords(crsIds: list) -> dict:
+    from course.views import get_time_json
+    records = {}
+    for c in Course.objects.filter(course_id__in=crsIds).prefetch_related('times'):
+        records[c.course_id] = {
+            "course_id": c.course_id,
+            "name": c.name,
+            "credit": c.credit,
+            "main_class": c.main_class,
+            "sub_class": c.sub_class,
+            "times": get_time_json(c),
+            "lecturer": c.lecturer,
+            "pos": c.pos,
+            "dept": c.dept,
+            "name_eng": c.name_eng,
+            "prerequisite": c.prerequisite,
+            "detail": c.detail,
+            "capacity": c.capacity,
+        }
+    return records
+
+
+class CatalogueCache:
+    def __init__(self, alias: str = None, localTtl: float = None):
+        self.alias = alias
+        self.lock = threading.Lock()
+        self.records = {}
+        self.version = None
+        self.localTtl = localTtl
+        # In-process mode only: the whole local copy is dropped at this time
+        self.expireAt = None
+        # Called with the ids changed by other processes (None means everything)
+        self.listeners = []
+        self.hits = 0
+        self.sharedHits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def shared(self):
+        if self.alias is None:
+            return None
+        return caches[self.alias]
+
+    def reset(self):
+        with self.lock:
+            self.records = {}
+            self.version = None
+            self.expireAt = None
+
+    def _notify(self, crsIds):
+        for listener in self.listeners:
+            listener(crsIds)
+
+    # 进程内模式下定期丢弃全部记录，其他进程的修改最多延迟localTtl秒
+    def _expireLocal(self):
+        if self.localTtl is None:
+            return
+        now = time.time()
+        with self.lock:
+            if self.expireAt is None:
+                self.expireAt = now + self.localTtl
+                return
+            if now < self.expireAt:
+                return
+            self.records = {}
+            self.expireAt = now + self.localTtl
+        self._notify(None)
+
+    # 与共享缓存的版本号同步，丢弃其他进程失效的课程
+    def sync(self):
+        shared = self.shared()
+        if shared is None:
+            self._expireLocal()
+            return
+        curVersion = shared.get(VERSION_KEY, 0)
+        with self.lock:
+            if self.version is None or curVersion == self.version:
+                self.version = curVersion
+                return
+            changed = None
+            if self.version < curVersion <= self.version + MAX_CHANGE_REPLAY:
+                keys = [CHANGE_KEY.format(v) for v in range(self.version + 1, curVersion + 1)]
+                changes = shared.get_many(keys)
+                if len(changes) == len(keys) and RESET not in changes.values():
+                    changed = set()
+                    for crsIds in changes.values():
+                        changed.update(crsIds)
+            if changed is None:
+                self.records = {}
+            else:
+                for crsId in changed:
+                    self.records.pop(crsId, None)
+            self.version = curVersion
+        self._notify(changed)
+
+    def getMany(self, crsIds: list) -> dict:
+        self.sync()
+        ret = {}
+        with self.lock:
+            for crsId in crsIds:
+                record = self.records.get(crsId)
+                if record is not None:
+                    ret[crsId] = record
+            self.hits += len(ret)
+            version = self.version
+        missing = [crsId for crsId in crsIds if crsId not in ret]
+        if not missing:
+            return ret
+
+        shared = self.shared()
+        found = {}
+        if shared is not None:
+            for key, record in shared.get_many([RECORD_KEY.format(crsId) for crsId in missing]).items():
+                found[record['course_id']] = record
+        loaded = loadRecords([crsId for crsId in missing if crsId not in found])
+        # Do not publish records loaded while another process was changing them
+        if shared is not None and loaded and shared.get(VERSION_KEY, 0) == version:
+            shared.set_many({RECORD_KEY.format(crsId): record for crsId, record in loaded.items()},
+                            RECORD_TTL)
+
+        with self.lock:
+            self.sharedHits += len(found)
+            self.misses += len(missing) - len(found)
+            if self.version == version:
+                self.records.update(found)
+                self.records.update(loaded)
+        ret.update(found)
+        ret.update(loaded)
+        return ret
+
+    def get(self, crsId: str):
+        return self.getMany([crsId]).get(crsId)
+
+    # 课程被教务修改或删除后调用
+    def invalidate(self, crsIds: list):
+        crsIds = [str(crsId) for crsId in crsIds]
+        with self.lock:
+            for crsId in crsIds:
+                self.records.pop(crsId, None)
+            self.invalidations += len(crsIds)
+        shared = self.shared()
+        if shared is None:
+            return
+        shared.delete_many([RECORD_KEY.format(crsId) for crsId in crsIds])
+        shared.add(VERSION_KEY, 0, None)
+        newVersion = shared.incr(VERSION_KEY)
+        if not shared.add(CHANGE_KEY.format(newVersion), crsIds, CHANGE_TTL):
+            # incr is a read-modify-write on some backends (e.g. FileBasedCache) and another
+            # process got the same version. Only one change list fits, so make every process
+            # drop its whole local copy: overwrite this version and the next one with RESET,
+            # the next one covers processes that already replayed the other list
+            logging.error('Catalogue cache version {} taken by another invalidation'.format(newVersion))
+            shared.set(CHANGE_KEY.format(newVersion), RESET, CHANGE_TTL)
+            newVersion = shared.incr(VERSION_KEY)
+            shared.set(CHANGE_KEY.format(newVersion), RESET, CHANGE_TTL)
+            return
+        with self.lock:
+            # Our own change, no need to replay it on the next sync
+            if self.version == newVersion - 1:
+                self.version = newVersion
+        logging.debug('Catalogue cache invalidated to version {}: {}'.format(newVersion, crsIds))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'shared_hits': self.sharedHits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self.records),
+                'version': self.version,
+                'shared': self.alias is not None,
+            }
+
+
+catalogueCache = CatalogueCache(CATALOGUE_CACHE, CATALOGUE_LOCAL_TTL)
@@ -0,0 +1,142 @@
+import logging
+from django.db import transaction
+from course.models import Course, Time, timesToMask, splitMask
+from course.search import courseIndex
+from course.cache import catalogueCache
+from election.models import Election
+from elect_system.settings import ERR_TYPE, COURSE_IMPORT_BATCH
+
+'''
+课程目录的批量导入
+
+与逐门课程create、逐个时间段查询或创建Time、逐个times.add相比：
+    所有课程先在内存中校验，任何一门课程有错误时不写入任何数据
+    已存在的课程号用一次查询找出
+    Time表一次读入内存，缺少的时间段用一次bulk_create补齐
+    课程用bulk_create插入（upsert时已存在的课程用bulk_update修改），
+    时间位图在内存中计算，课程与时间的关系用一次through表的bulk_create写入
+    以上全部在一个事务中完成，之后再使目录缓存和搜索索引失效
+返回(写入的课程数, 错误列表)，错误为{'index': 下标（从0开始）, 'course_id': 课程号, 'msg': ERR_TYPE.X}
+
+upsert时与课程修改接口一致：容量不能小于已选上的人数（否则该课程报PARAM_ERR）；
+已经有学生选了的课程保留原来的上课时间，导入数据中的times对这些课程不生效，
+否则会与学生课表中的其他课程冲突。
+'''
+
+# Metadata columns rewritten by an upsert, the election counters are kept
+UPSERT_FIELDS = ['name', 'credit', 'main_class', 'sub_class', 'lecturer', 'pos', 'dept',
+                 'name_eng', 'prerequisite', 'detail', 'capacity', 'slot_mask_lo', 'slot_mask_hi']
+
+
+# 校验一门课程，返回(Course对象, 上课时间段的集合)，格式错误时抛出ValueError
+def parseCourse(crs) -> tuple:
+    if not isinstance(crs, dict):
+        raise ValueError('course is not an object')
+    times = crs.get('times')
+    if not isinstance(times, list):
+        raise ValueError('times is not a list')
+    slots = set()
+    for tim in times:
+        if not isinstance(tim, dict):
+            raise ValueError('time is not an object')
+        day = tim.get('day')
+        periods = tim.get('period')
+        if not isinstance(day, int) or not 1 <= day <= 7 or not isinstance(periods, list):
+            raise ValueError('invalid day {}'.format(day))
+        for period in periods:
+            if not isinstance(period, int) or not 1 <= period <= 14:
+                raise ValueError('invalid period {}'.format(period))
+            slots.add((day, period))
+
+    if crs.get('course_id') is None:
+        raise ValueError('missing course_id')
+    lo, hi = splitMask(timesToMask(slots))
+    c = Course(course_id=str(crs.get('course_id')), name=str(crs.get('name')), credit=int(crs.get('credit')),
+               lecturer=crs.get('lecturer'), pos=crs.get('pos'), dept=int(crs.get('dept')),
+               main_class=int(crs.get('main_class')), sub_class=crs.get('sub_class'),
+               name_eng=crs.get('name_eng'), prerequisite=crs.get('prerequisite'),
+               detail=crs.get('detail'), capacity=int(crs.get('capacity')),
+               slot_mask_lo=lo, slot_mask_hi=hi)
+    return c, slots
+
+
+# {(day, period): Time.id}，缺少的时间段在这里补齐
+def loadTimeMap(slots: set) -> dict:
+    timeMap = {}
+    # Older data may hold duplicated slots, keep the first one like the old lookup did
+    for tId, day, period in Time.objects.order_by('-id').values_list('id', 'day', 'period'):
+        timeMap[(day, period)] = tId
+    missing = slots - timeMap.keys()
+    if missing:
+        Time.objects.bulk_create([Time(day=day, period=period) for day, period in sorted(missing)])
+        for tId, day, period in Time.objects.order_by('-id').values_list('id', 'day', 'period'):
+            timeMap.setdefault((day, period), tId)
+    return timeMap
+
+
+# upsert为False时已存在的课程报COURSE_DUP，为True时修改已存在课程的信息和上课时间
+def importCourses(crss: list, upsert: bool = False, batchSize: int = COURSE_IMPORT_BATCH):
+    errors = []
+    parsed = []
+    seen = set()
+    for idx, crs in enumerate(crss):
+        try:
+            c, slots = parseCourse(crs)
+        except (ValueError, TypeError):
+            logging.error('Import course param error, crs={}'.format(crs))
+            errors.append({'index': idx, 'course_id': crs.get('course_id') if isinstance(crs, dict) else None,
+                           'msg': ERR_TYPE.PARAM_ERR})
+            continue
+        if c.course_id in seen:
+            errors.append({'index': idx, 'course_id': c.course_id, 'msg': ERR_TYPE.COURSE_DUP})
+            continue
+        seen.add(c.course_id)
+        parsed.append((idx, c, slots))
+
+    # crsId -> (elect_num, slot_mask_lo, slot_mask_hi)
+    existing = {crsId: rest for crsId, *rest in Course.objects.filter(course_id__in=seen).values_list(
+        'course_id', 'elect_num', 'slot_mask_lo', 'slot_mask_hi')}
+    if existing and not upsert:
+        logging.error('Cannot add for courses already exist, crsIds={}'.format(sorted(existing)))
+        errors.extend({'index': idx, 'course_id': c.course_id, 'msg': ERR_TYPE.COURSE_DUP}
+                      for idx, c, slots in parsed if c.course_id in existing)
+    for idx, c, slots in parsed:
+        if upsert and c.course_id in existing and c.capacity < existing[c.course_id][0]:
+            logging.error('Cannot decrease course capacity below elect num, crsId={}, {}<{}'.format(
+                c.course_id, c.capacity, existing[c.course_id][0]))
+            errors.append({'index': idx, 'course_id': c.course_id, 'msg': ERR_TYPE.PARAM_ERR})
+    if errors:
+        errors.sort(key=lambda e: e['index'])
+        return 0, errors
+
+    newCourses = [c for idx, c, slots in parsed if c.course_id not in existing]
+    oldCourses = [c for idx, c, slots in parsed if c.course_id in existing]
+    # Courses with elections keep their times, the imported ones are ignored
+    keepTimes = set(Election.objects.filter(crs_id__in=[c.course_id for c in oldCourses]).values_list(
+        'crs_id', flat=True).distinct()) if oldCourses else set()
+    if keepTimes:
+        logging.warn('Keep the times of {} courses with elections: {}'.format(len(keepTimes), sorted(keepTimes)))
+    for c in oldCourses:
+        if c.course_id in keepTimes:
+            c.slot_mask_lo, c.slot_mask_hi = existing[c.course_id][1:]
+    timed = [(c, slots) for idx, c, slots in parsed if c.course_id not in keepTimes]
+    allSlots = set()
+    for c, slots in timed:
+        allSlots |= slots
+    with transaction.atomic():
+        timeMap = loadTimeMap(allSlots)
+        Course.objects.bulk_create(newCourses, batch_size=batchSize)
+        if oldCourses:
+            Course.objects.bulk_update(oldCourses, UPSERT_FIELDS, batch_size=batchSize)
+            # bulk operations do not send m2m_changed, the slot masks are set above
+            Course.times.through.objects.filter(
+                course_id__in=[c.course_id for c in oldCourses if c.course_id not in keepTimes]).delete()
+        Course.times.through.objects.bulk_create(
+            [Course.times.through(course_id=c.course_id, time_id=timeMap[slot])
+             for c, slots in timed for slot in sorted(slots)], batch_size=batchSize)
+
+    catalogueCache.invalidate([c.course_id for idx, c, slots in parsed])
+    for idx, c, slots in parsed:
+        courseIndex.update(c)
+    logging.info('Imported {} new courses, updated {} courses'.format(len(newCourses), len(oldCourses)))
+    return len(parsed), []
@@ -0,0 +1,32 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from course.importer import importCourses
+
+
+# 从json文件（{'courses': [...]}或列表，格式与课程的POST接口相同）批量导入课程目录
+class Command(BaseCommand):
+    help = 'Import a course catalogue from a json file in one transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='A json file with the courses')
+        parser.add_argument('--upsert', action='store_true',
+                            help='Update courses that already exist instead of failing')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], encoding='utf-8-sig') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError('Cannot read {}: {}'.format(options['path'], e))
+        crss = data.get('courses') if isinstance(data, dict) else data
+        if not isinstance(crss, list):
+            raise CommandError('No course list in {}'.format(options['path']))
+
+        startTime = time.time()
+        count, errors = importCourses(crss, upsert=options['upsert'])
+        for e in errors:
+            self.stdout.write('course {index} id={course_id}: {msg}'.format(**e))
+        if errors:
+            raise CommandError('{} courses failed, nothing is imported'.format(len(errors)))
+        self.stdout.write('{} courses imported, {:.1f}s'.format(count, time.time() - startTime))
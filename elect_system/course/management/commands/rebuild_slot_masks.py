@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from course.models import Course
+
+
+# 按照课程的times重新计算所有课程的时间位图（用于旧数据迁移或修复）
+class Command(BaseCommand):
+    help = 'Recompute Course.slot_mask_lo/slot_mask_hi from the times relation'
+
+    def handle(self, *args, **options):
+        fixed = Course.refreshAllSlotMasks()
+        self.stdout.write('{} course slot masks rebuilt'.format(fixed))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from election.models import Election
+from user.models import User
+
+
+# 检查（并修复）课程上的已选上/待抽签人数计数器、学生的已用意愿点与选课记录之间的偏差，
+# 以及学生的未读消息计数
+# NOTE: 修复时最好关闭选课，否则修复期间新增的选课可能被覆盖
+class Command(BaseCommand):
+    help = 'Detect drift of Course.elect_num/elect_newround_num, User.curWp and User.unreadMsgNum'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Repair the drifted counters')
+
+    def handle(self, *args, **options):
+        drift = Election.reconcileCourseCounters(fix=options['fix'])
+        for crsId, counters, actual in drift:
+            self.stdout.write('course {}: counters (elected, pending)={}, actual={}'.format(
+                crsId, counters, actual))
+        self.stdout.write('{} drifted courses{}'.format(
+            len(drift), ' repaired' if options['fix'] and drift else ''))
+
+        drift = Election.reconcileStudentWp(fix=options['fix'])
+        for uid, curWp, actual in drift:
+            self.stdout.write('student {}: curWp={}, actual={}'.format(uid, curWp, actual))
+        self.stdout.write('{} drifted students{}'.format(
+            len(drift), ' repaired' if options['fix'] and drift else ''))
+
+        drift = User.reconcileUnread(fix=options['fix'])
+        for uid, num, actual in drift:
+            self.stdout.write('student {}: unreadMsgNum={}, actual={}'.format(uid, num, actual))
+        self.stdout.write('{} drifted unread counters{}'.format(
+            len(drift), ' repaired' if options['fix'] and drift else ''))
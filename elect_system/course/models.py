@@ -1,5 +1,8 @@
 from user.models import User
 from django.db import models
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 import sys
 import logging
 sys.path.append("..")
@@ -18,7 +21,9 @@ Course 类
     dept：开课院系
     detail：课程详情
     capacity：课程最大选课人数
-    electnum：课程当前选课人数
+    elect_num：课程当前已选上的人数（计数器，由选课和抽签在事务中维护）
+    elect_newround_num：课程当前待抽签的人数（计数器，同上）
+    slot_mask_lo/slot_mask_hi：上课时间的位图（见slotMask），与times保持同步
 '''
 # 院系列表详细信息
 DEPT = [
@@ -137,6 +142,31 @@ class Time(models.Model):
     period = models.IntegerField(default=1)
 
 
+# 一周7天、每天14节课共98个时间段，每个时间段占位图中的一位。
+# 一个BigInteger放不下，周一到周四存在slot_mask_lo，周五到周日存在slot_mask_hi
+PERIOD_NUM = 14
+LO_MASK_BITS = 4 * PERIOD_NUM
+
+
+def slotMask(day: int, period: int) -> int:
+    return 1 << ((day - 1) * PERIOD_NUM + period - 1)
+
+
+def timesToMask(times) -> int:
+    mask = 0
+    for day, period in times:
+        mask |= slotMask(day, period)
+    return mask
+
+
+def splitMask(mask: int):
+    return mask & ((1 << LO_MASK_BITS) - 1), mask >> LO_MASK_BITS
+
+
+def joinMask(lo: int, hi: int) -> int:
+    return lo | (hi << LO_MASK_BITS)
+
+
 class Course(models.Model):
     course_id = models.CharField(max_length=256, primary_key=True)
     name = models.CharField(max_length=128, null=True)
@@ -153,8 +183,10 @@ class Course(models.Model):
 
     capacity = models.IntegerField(default=50)
     elect_num = models.IntegerField(default=0)
-    elect_newround_num = models.IntegerField(default=0) # 该属性没有被使用到
+    elect_newround_num = models.IntegerField(default=0)
     times = models.ManyToManyField(Time)
+    slot_mask_lo = models.BigIntegerField(default=0)
+    slot_mask_hi = models.BigIntegerField(default=0)
     #检查课程id是否重复
     def getCourseObj(crsId: str):
         crsSet = Course.objects.filter(course_id=crsId)
@@ -167,3 +199,65 @@ class Course(models.Model):
     def isLegal(crsId: str) -> bool:
         return Course.objects.filter(course_id=crsId).exists()
 
+    # 原子地调整课程的已选上/待抽签人数计数器，需要在选课记录变化的同一事务中调用
+    def bumpElectionCounters(crsId: str, elected: int = 0, pending: int = 0):
+        Course.objects.filter(course_id=crsId).update(
+            elect_num=F('elect_num') + elected,
+            elect_newround_num=F('elect_newround_num') + pending)
+
+    # 在数据库中筛选时间位图与mask有交集的课程
+    def filterSlotsAny(courseSet, mask: int):
+        lo, hi = splitMask(mask)
+        return courseSet.annotate(
+            slot_hit_lo=F('slot_mask_lo').bitand(lo),
+            slot_hit_hi=F('slot_mask_hi').bitand(hi)).filter(
+            Q(slot_hit_lo__gt=0) | Q(slot_hit_hi__gt=0))
+
+    # 在数据库中筛选时间位图与mask没有交集的课程
+    def filterSlotsFree(courseSet, mask: int):
+        lo, hi = splitMask(mask)
+        return courseSet.annotate(
+            slot_free_lo=F('slot_mask_lo').bitand(lo),
+            slot_free_hi=F('slot_mask_hi').bitand(hi)).filter(
+            slot_free_lo=0, slot_free_hi=0)
+
+    def getSlotMask(self) -> int:
+        return joinMask(self.slot_mask_lo, self.slot_mask_hi)
+
+    # 按照times重新计算课程的时间位图
+    def refreshSlotMask(self):
+        lo, hi = splitMask(timesToMask(self.times.values_list('day', 'period')))
+        self.slot_mask_lo, self.slot_mask_hi = lo, hi
+        Course.objects.filter(course_id=self.course_id).update(
+            slot_mask_lo=lo, slot_mask_hi=hi)
+
+    # 一次查询重新计算所有课程的时间位图，返回被修正的课程数量
+    def refreshAllSlotMasks() -> int:
+        masks = {}
+        for crsId, day, period in Course.times.through.objects.values_list(
+                'course_id', 'time__day', 'time__period'):
+            masks[crsId] = masks.get(crsId, 0) | slotMask(day, period)
+        stale = []
+        for c in Course.objects.only('course_id', 'slot_mask_lo', 'slot_mask_hi'):
+            lo, hi = splitMask(masks.get(c.course_id, 0))
+            if (c.slot_mask_lo, c.slot_mask_hi) != (lo, hi):
+                c.slot_mask_lo, c.slot_mask_hi = lo, hi
+                stale.append(c)
+        Course.objects.bulk_update(stale, ['slot_mask_lo', 'slot_mask_hi'], batch_size=1000)
+        return len(stale)
+
+
+@receiver(m2m_changed, sender=Course.times.through)
+def syncSlotMask(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance is a Time, remember the affected courses before clearing
+        if action == 'pre_clear':
+            instance._slotMaskCourses = list(instance.course_set.values_list('course_id', flat=True))
+            return
+        if action == 'post_clear':
+            pk_set = getattr(instance, '_slotMaskCourses', [])
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            for c in Course.objects.filter(course_id__in=pk_set):
+                c.refreshSlotMask()
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        instance.refreshSlotMask()
@@ -0,0 +1,275 @@
+import logging
+import threading
+from django.db import connection
+from course.models import Course
+from course.cache import catalogueCache
+
+# 拼音首字母匹配是可选功能，没有安装pypinyin时只支持原文匹配
+try:
+    from pypinyin import lazy_pinyin, Style
+except ImportError:
+    lazy_pinyin = None
+
+'''
+课程搜索的进程内倒排索引
+
+对course_id、name、name_eng、lecturer（以及name、lecturer的拼音首字母）建立
+单字和双字的倒排表，查询时先求倒排表的交集得到候选课程，再逐个校验子串并打分：
+    完全匹配 > 前缀匹配 > 子串匹配，同一匹配程度下按字段权重排序
+索引在第一次查询时从数据库构建，之后由课程的增删改接口增量更新；
+其他进程修改的课程通过目录缓存（course/cache.py）的版本同步得知：
+设置了共享缓存时按共享的版本号重新读取被修改的课程，进程内模式下随目录缓存到期在后台线程中
+与数据库比较，只重新索引有变化的课程，期间查询继续使用现有的索引。
+'''
+
+# Field weights, a hit on the course id ranks above a hit on the lecturer
+FIELD_WEIGHT = {
+    'course_id': 4,
+    'name': 3,
+    'name_py': 3,
+    'name_eng': 2,
+    'lecturer': 1,
+    'lecturer_py': 1,
+}
+EXACT, PREFIX, SUBSTR = 3, 2, 1
+
+
+def normalize(text) -> str:
+    if text is None:
+        return ''
+    return ''.join(str(text).lower().split())
+
+
+def pinyinInitials(text) -> str:
+    if lazy_pinyin is None or not text:
+        return ''
+    return ''.join(lazy_pinyin(str(text), style=Style.FIRST_LETTER, errors='ignore')).lower()
+
+
+def grams(text: str) -> set:
+    g = set(text)
+    g.update(text[i:i + 2] for i in range(len(text) - 1))
+    return g
+
+
+def sourceOf(values: dict) -> tuple:
+    return values.get('name'), values.get('name_eng'), values.get('lecturer')
+
+
+# 返回(display dict, {field: normalized text}, 建索引用到的原始字段)，拼音在这里计算
+def makeDoc(values: dict) -> tuple:
+    crsId = values['course_id']
+    texts = {
+        'course_id': normalize(crsId),
+        'name': normalize(values.get('name')),
+        'name_eng': normalize(values.get('name_eng')),
+        'lecturer': normalize(values.get('lecturer')),
+        'name_py': pinyinInitials(values.get('name')),
+        'lecturer_py': pinyinInitials(values.get('lecturer')),
+    }
+    display = {
+        'course_id': crsId,
+        'name': values.get('name'),
+        'lecturer': values.get('lecturer'),
+    }
+    return display, texts, sourceOf(values)
+
+
+def addDoc(docs: dict, postings: dict, crsId: str, doc: tuple):
+    docs[crsId] = doc
+    for text in doc[1].values():
+        for g in grams(text):
+            postings.setdefault(g, set()).add(crsId)
+
+
+class CourseIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Only one build or resync runs at a time, searches do not wait for it
+        self.buildLock = threading.Lock()
+        self.built = False
+        # Bumped by reset, a build or resync started before it is dropped
+        self.epoch = 0
+        # crsId -> makeDoc(...)
+        self.docs = {}
+        # gram -> set of crsId
+        self.postings = {}
+        # Courses changed by other processes, reloaded on the next search
+        self.stale = set()
+        # Any course may have been changed by another process, resynced in the background
+        self.outdated = False
+        self.resyncing = False
+        # Courses updated locally while a build or resync is reading the table (None otherwise)
+        self.touched = None
+
+    def reset(self):
+        with self.lock:
+            self.built = False
+            self.epoch += 1
+            self.docs = {}
+            self.postings = {}
+            self.stale = set()
+            self.outdated = False
+            self.touched = None
+
+    # 在锁外读取全部课程并计算拼音，完成后一次替换docs和postings。已经构建过时直接返回
+    def build(self):
+        with self.buildLock:
+            with self.lock:
+                if self.built:
+                    return
+                epoch = self.epoch
+                self.touched = set()
+            docs, postings = {}, {}
+            for values in Course.objects.values('course_id', 'name', 'name_eng', 'lecturer').iterator():
+                addDoc(docs, postings, values['course_id'], makeDoc(values))
+            with self.lock:
+                if self.epoch != epoch:
+                    return
+                # The table was read before these local changes, reload them on the next search
+                self.stale = self.touched
+                self.touched = None
+                self.docs, self.postings = docs, postings
+                self.outdated = False
+                self.built = True
+            logging.info('Course search index built, {} courses'.format(len(docs)))
+
+    # 与数据库比较，只重新索引名称、英文名或教师有变化的课程以及新增、删除的课程。
+    # 读表和计算拼音都在锁外，持有锁的只有最后的替换
+    def resync(self):
+        with self.buildLock:
+            with self.lock:
+                if not self.built:
+                    return
+                epoch = self.epoch
+                self.outdated = False
+                self.touched = set()
+                sources = {crsId: doc[2] for crsId, doc in self.docs.items()}
+            changed = {}
+            for values in Course.objects.values('course_id', 'name', 'name_eng', 'lecturer').iterator():
+                crsId = values['course_id']
+                if sources.pop(crsId, None) != sourceOf(values):
+                    changed[crsId] = makeDoc(values)
+            with self.lock:
+                if self.epoch != epoch:
+                    return
+                # Courses updated locally meanwhile are already newer than what was read
+                touched, self.touched = self.touched, None
+                for crsId, doc in changed.items():
+                    if crsId not in touched:
+                        self._remove(crsId)
+                        addDoc(self.docs, self.postings, crsId, doc)
+                for crsId in sources:
+                    if crsId not in touched:
+                        self._remove(crsId)
+            logging.info('Course search index resynced, {} changed, {} removed'.format(len(changed), len(sources)))
+
+    def _resyncInBackground(self):
+        try:
+            self.resync()
+        except Exception as e:
+            logging.error('Course search index resync failed: {}'.format(e))
+            with self.lock:
+                self.outdated = True
+        finally:
+            with self.lock:
+                self.resyncing = False
+            connection.close()
+
+    def _add(self, values: dict):
+        addDoc(self.docs, self.postings, values['course_id'], makeDoc(values))
+
+    def _remove(self, crsId: str):
+        doc = self.docs.pop(crsId, None)
+        if doc is None:
+            return
+        for text in doc[1].values():
+            for g in grams(text):
+                posting = self.postings.get(g)
+                if posting is not None:
+                    posting.discard(crsId)
+                    if not posting:
+                        del self.postings[g]
+
+    # 课程新增或修改后调用。索引尚未构建时不需要处理，构建时会读到最新数据
+    def update(self, course: Course):
+        with self.lock:
+            if self.touched is not None:
+                self.touched.add(course.course_id)
+            if not self.built:
+                return
+            self._remove(course.course_id)
+            self._add({'course_id': course.course_id, 'name': course.name,
+                       'name_eng': course.name_eng, 'lecturer': course.lecturer})
+
+    def remove(self, crsId: str):
+        with self.lock:
+            if self.touched is not None:
+                self.touched.add(crsId)
+            if self.built:
+                self._remove(crsId)
+
+    # 目录缓存发现其他进程修改了课程时调用，crsIds为None表示全部课程：
+    # 这时不丢弃索引，查询继续使用现有的索引，同时在后台线程中resync
+    def markStale(self, crsIds):
+        with self.lock:
+            if not self.built:
+                return
+            if crsIds is None:
+                self.outdated = True
+            else:
+                self.stale.update(crsIds)
+
+    def _refreshStale(self):
+        stale, self.stale = self.stale, set()
+        for crsId in stale:
+            self._remove(crsId)
+        for values in Course.objects.filter(course_id__in=stale).values(
+                'course_id', 'name', 'name_eng', 'lecturer'):
+            self._add(values)
+
+    # 返回按相关度排序的[(display dict, score)]，limit为None时返回全部命中
+    def search(self, query: str, limit: int = None) -> list:
+        q = normalize(query)
+        if not q:
+            return []
+        catalogueCache.sync()
+        if not self.built:
+            self.build()
+        with self.lock:
+            if self.stale:
+                self._refreshStale()
+            if self.outdated and not self.resyncing:
+                self.resyncing = True
+                threading.Thread(target=self._resyncInBackground, daemon=True).start()
+            if len(q) == 1:
+                keys = [q]
+            else:
+                keys = [q[i:i + 2] for i in range(len(q) - 1)]
+            postings = sorted((self.postings.get(k, set()) for k in keys), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+
+            hits = []
+            for crsId in candidates:
+                display, texts, source = self.docs[crsId]
+                score = 0
+                for field, text in texts.items():
+                    if text == q:
+                        level = EXACT
+                    elif text.startswith(q):
+                        level = PREFIX
+                    elif q in text:
+                        level = SUBSTR
+                    else:
+                        continue
+                    score = max(score, level * 10 + FIELD_WEIGHT[field])
+                if score:
+                    hits.append((display, score))
+        hits.sort(key=lambda h: (-h[1], len(h[0]['name'] or ''), h[0]['course_id']))
+        if limit is not None:
+            hits = hits[:limit]
+        return hits
+
+
+courseIndex = CourseIndex()
+catalogueCache.listeners.append(courseIndex.markStale)
@@ -1,11 +1,23 @@
 from django.test import TestCase
-from .models import Course
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from .models import Course, Time, slotMask, joinMask
 from user.models import User
 import json
-from elect_system.settings import ERR_TYPE
+from unittest import mock
+from elect_system.settings import ERR_TYPE, ELE_TYPE
+from election.models import Election
 from .views import check_time_format
+from .search import courseIndex, lazy_pinyin, pinyinInitials
+from .cache import catalogueCache, CatalogueCache, CHANGE_KEY, RECORD_KEY, VERSION_KEY
+from django.core.cache import caches
 #用于course类的测试类
 class CourseTests(TestCase):
+    def setUp(self):
+        # 搜索索引和目录缓存在进程内，每个测试都需要从测试数据库重新构建
+        courseIndex.reset()
+        catalogueCache.reset()
+
     def test_courses(self):
         # 首先创建一个用于添加、修改课程的教务账户
         u = User.objects.create_user('jyeecs', password='123456')
@@ -181,6 +193,34 @@ class CourseTests(TestCase):
         self.assertEqual(resp.get('success'), True)
         self.assertEqual(len(resp.get('course_list')), 1)
 
+        # 分页查询，每页两门课程
+        courseIds = []
+        cursor = ''
+        for i in range(3):
+            respData = self.client.get('/course/courses?limit=2&cursor=' + cursor)
+            resp = respData.json()
+            self.assertEqual(resp.get('success'), True)
+            courseIds += [crs.get('course_id') for crs in resp.get('course_list')]
+            cursor = resp.get('next_cursor') or ''
+        self.assertEqual(cursor, '')
+        self.assertEqual(courseIds, sorted(courseIds))
+        self.assertEqual(len(set(courseIds)), 5)
+
+        # 只返回指定的字段
+        respData = self.client.get('/course/courses?id=4830550&fields=course_id,name,detail')
+        resp = respData.json()
+        self.assertEqual(list(resp.get('course_list')[0].keys()), ['course_id', 'name', 'detail'])
+        respData = self.client.get('/course/courses?fields=course_id,password')
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.PARAM_ERR)
+
+        # 教务流式导出课程列表，导出的课程不进入目录缓存
+        catalogueCache.reset()
+        respData = self.client.get('/course/courses?stream=1&fields=course_id,times')
+        resp = json.loads(b''.join(respData.streaming_content).decode())
+        self.assertEqual(len(resp.get('course_list')), 5)
+        self.assertEqual(catalogueCache.stats().get('size'), 0)
+        self.assertEqual(resp.get('course_list')[0].get('course_id'), courseIds[0])
+
         # 教务删除课程
         respData = self.client.delete('/course/courses/1233346')
         resp = respData.json()
@@ -237,6 +277,30 @@ class CourseTests(TestCase):
         self.assertEqual(len(resp.get('course_list')), 1)
         self.assertEqual(resp.get('course_list')[0].get('name'), '天体物理专题')
 
+        # 按上课时间查询（任一节次有课即可）
+        respData = self.client.get('/course/courses?day=2&period=2,3')
+        resp = respData.json()
+        self.assertEqual(resp.get('success'), True)
+        self.assertEqual(len(resp.get('course_list')), 2)
+        respData = self.client.get('/course/courses?day=1')
+        self.assertEqual(len(respData.json().get('course_list')), 2)
+        respData = self.client.get('/course/courses?day=1&period=15')
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.PARAM_ERR)
+        respData = self.client.get('/course/courses?free=1')
+        self.assertEqual(len(respData.json().get('course_list')), 4)
+
+        # 查询的数据库访问次数与结果数量无关
+        with CaptureQueriesContext(connection) as oneQueries:
+            respData = self.client.get('/course/courses?dept=4&main_class=0')
+        with CaptureQueriesContext(connection) as allQueries:
+            respData = self.client.get('/course/courses')
+        self.assertEqual(len(respData.json().get('course_list')), 4)
+        self.assertEqual(len(oneQueries), len(allQueries))
+
+        # 学生不能流式导出课程列表
+        respData = self.client.get('/course/courses?stream=1')
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.NOT_ALLOWED)
+
         # 学生没有删除/修改课程的权限
         respData = self.client.post(
             '/course/courses', json.dumps({'courses': [crs0, ]}), content_type="application/json")
@@ -246,3 +310,259 @@ class CourseTests(TestCase):
         respData = self.client.delete('/course/courses/1233346')
         resp = respData.json()
         self.assertEqual(resp.get('msg'), ERR_TYPE.NOT_ALLOWED)
+
+    def test_slot_mask(self):
+        u = User.objects.create_user('jyeecs', password='123456')
+        u.is_superuser = True
+        u.save()
+        respData = self.client.post(
+            '/user/login', json.dumps({'uid': 'jyeecs', 'password': '123456'}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+        crs = {
+            "course_id": 4830550,
+            "name": "存储技术基础",
+            "credit": 2,
+            "main_class": 0,
+            "sub_class": "A",
+            "times": [
+                {"day": 1, "period": [1, 14]},
+                {"day": 7, "period": [12]}
+            ],
+            "lecturer": "汪小林",
+            "pos": "理教201",
+            "dept": 48,
+            "capacity": 150,
+        }
+        respData = self.client.post(
+            '/course/courses', json.dumps({'courses': [crs, ]}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+        # 课程的时间位图与times保持一致
+        c = Course.objects.get(course_id='4830550')
+        mask = slotMask(1, 1) | slotMask(1, 14) | slotMask(7, 12)
+        self.assertEqual(c.getSlotMask(), mask)
+        self.assertEqual(joinMask(*Course.objects.values_list('slot_mask_lo', 'slot_mask_hi').get(course_id='4830550')), mask)
+
+        c.times.remove(Time.objects.get(day=7, period=12))
+        self.assertEqual(Course.objects.get(course_id='4830550').getSlotMask(), slotMask(1, 1) | slotMask(1, 14))
+
+        Course.objects.filter(course_id='4830550').update(slot_mask_lo=0, slot_mask_hi=0)
+        self.assertEqual(Course.refreshAllSlotMasks(), 1)
+        self.assertEqual(Course.objects.get(course_id='4830550').getSlotMask(), slotMask(1, 1) | slotMask(1, 14))
+
+    def test_search(self):
+        u = User.objects.create_user('jyeecs', password='123456')
+        u.is_superuser = True
+        u.save()
+        respData = self.client.post(
+            '/user/login', json.dumps({'uid': 'jyeecs', 'password': '123456'}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+        crss = [
+            {"course_id": 4830010, "name": "信息科学技术概论", "name_eng": "Introduction to Information Science",
+             "lecturer": "王源", "times": [{"day": 1, "period": [7, 8]}]},
+            {"course_id": 4831230, "name": "信息", "lecturer": "李文新", "times": [{"day": 3, "period": [1, 2]}]},
+            {"course_id": 1233346, "name": "软件工程", "lecturer": "孙艳春", "times": [{"day": 2, "period": [3, 4]}]},
+        ]
+        for crs in crss:
+            crs.update({"credit": 2, "main_class": 0, "sub_class": "A", "pos": "理教201", "dept": 48, "capacity": 100})
+        respData = self.client.post(
+            '/course/courses', json.dumps({'courses': crss}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+        # showallcourse按next_cursor翻页
+        resp = self.client.post('/course/showallcourse?limit=2').json()
+        self.assertEqual([c.get('course_id') for c in resp.get('msg')], ['1233346', '4830010'])
+        resp = self.client.post('/course/showallcourse?limit=2&cursor={}'.format(resp.get('next_cursor'))).json()
+        self.assertEqual([c.get('course_id') for c in resp.get('msg')], ['4831230'])
+        self.assertIsNone(resp.get('next_cursor'))
+
+        # 完全匹配排在前缀匹配之前
+        respData = self.client.get('/course/search?q=信息')
+        resp = respData.json()
+        self.assertEqual(resp.get('success'), True)
+        self.assertEqual([h.get('course_id') for h in resp.get('data')], ['4831230', '4830010'])
+
+        # 子串、英文名、教师、课程号前缀
+        self.assertEqual(courseIndex.search('技术')[0][0]['course_id'], '4830010')
+        self.assertEqual(courseIndex.search('information science')[0][0]['course_id'], '4830010')
+        self.assertEqual(courseIndex.search('艳春')[0][0]['course_id'], '1233346')
+        self.assertEqual(len(courseIndex.search('483')), 2)
+        self.assertEqual(courseIndex.search('不存在的课程'), [])
+        if lazy_pinyin is not None:
+            self.assertEqual(courseIndex.search('rjgc')[0][0]['course_id'], '1233346')
+
+        # 课程查询的name参数使用索引
+        respData = self.client.get('/course/courses?name=信息')
+        resp = respData.json()
+        self.assertEqual([c.get('course_id') for c in resp.get('course_list')], ['4831230', '4830010'])
+        # 分页时保持相关度顺序
+        resp = self.client.get('/course/courses?name=信息&limit=1').json()
+        self.assertEqual([c.get('course_id') for c in resp.get('course_list')], ['4831230'])
+        resp = self.client.get('/course/courses?name=信息&limit=1&cursor={}'.format(resp.get('next_cursor'))).json()
+        self.assertEqual([c.get('course_id') for c in resp.get('course_list')], ['4830010'])
+
+        # 其他进程新增的课程：通过共享缓存的版本号得知，下一次查询时读入索引
+        try:
+            caches['default'].clear()
+            catalogueCache.alias = 'default'
+            catalogueCache.reset()
+            courseIndex.reset()
+            self.assertEqual(courseIndex.search('数据结构'), [])
+            Course.objects.create(course_id='4831390', name='数据结构与算法', credit=3, lecturer='李文新',
+                                  pos='理教201', dept=48, sub_class='A')
+            CatalogueCache('default').invalidate(['4831390'])
+            self.assertEqual(courseIndex.search('数据结构')[0][0]['course_id'], '4831390')
+        finally:
+            catalogueCache.alias = None
+            catalogueCache.reset()
+            courseIndex.reset()
+
+        # 进程内模式下目录缓存到期：不丢弃索引，resync只重新计算有变化的课程
+        self.assertEqual(courseIndex.search('信息')[0][0]['course_id'], '4831230')
+        Course.objects.filter(course_id='4830010').update(name='信息科学')
+        catalogueCache.expireAt = 0
+        catalogueCache.sync()
+        self.assertTrue(courseIndex.built)
+        self.assertTrue(courseIndex.outdated)
+        with mock.patch('course.search.pinyinInitials', wraps=pinyinInitials) as pinyin:
+            courseIndex.resync()
+        self.assertEqual(pinyin.call_count, 2)
+        self.assertFalse(courseIndex.outdated)
+        self.assertEqual(courseIndex.search('信息科学')[0][0]['name'], '信息科学')
+        self.assertEqual(courseIndex.search('技术'), [])
+
+        # 修改、删除课程后索引随之更新
+        respData = self.client.put(
+            '/course/courses', json.dumps({'courses': [{"course_id": 1233346, "name": "软件工程导论"}]}),
+            content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+        self.assertEqual(courseIndex.search('导论')[0][0]['name'], '软件工程导论')
+        respData = self.client.delete('/course/courses/1233346')
+        self.assertEqual(respData.json().get('success'), True)
+        self.assertEqual(courseIndex.search('软件'), [])
+
+    def test_catalogue_cache(self):
+        u = User.objects.create_user('jyeecs', password='123456')
+        u.is_superuser = True
+        u.save()
+        respData = self.client.post(
+            '/user/login', json.dumps({'uid': 'jyeecs', 'password': '123456'}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+        crs = {"course_id": 4830010, "name": "信息科学技术概论", "credit": 2, "main_class": 0, "sub_class": "A",
+               "times": [{"day": 1, "period": [7, 8]}], "lecturer": "王源", "pos": "理教201",
+               "dept": 48, "capacity": 100}
+        respData = self.client.post(
+            '/course/courses', json.dumps({'courses': [crs, ]}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+        # 第一次读取未命中，之后的详情从缓存读取
+        respData = self.client.get('/course/courses')
+        self.assertEqual(respData.json().get('course_list')[0].get('name'), '信息科学技术概论')
+        respData = self.client.get('/course/courses/4830010/detail')
+        self.assertEqual(respData.json().get('lecturer'), '王源')
+        stats = self.client.get('/course/cachestats').json().get('data')
+        self.assertEqual(stats.get('misses'), 1)
+        self.assertEqual(stats.get('hits'), 1)
+
+        # 修改课程后缓存失效，读到新的数据
+        respData = self.client.put(
+            '/course/courses', json.dumps({'courses': [{"course_id": 4830010, "name": "信息科学技术导论"}]}),
+            content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+        respData = self.client.get('/course/courses/4830010/detail')
+        self.assertEqual(respData.json().get('name'), '信息科学技术导论')
+
+        # 修改容量只写回capacity一列，不覆盖选课计数器和时间位图
+        with CaptureQueriesContext(connection) as queries:
+            respData = self.client.put(
+                '/course/courses', json.dumps({'courses': [{"course_id": 4830010, "capacity": 120}]}),
+                content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('capacity', updates[0])
+        self.assertNotIn('elect_num', updates[0])
+        self.assertNotIn('slot_mask', updates[0])
+        respData = self.client.get('/course/courses/4830010/detail')
+        self.assertEqual(respData.json().get('capacity'), 120)
+
+        # 其他进程的修改：进程内模式下到期后丢弃全部记录
+        Course.objects.filter(course_id='4830010').update(name='信息科学')
+        self.assertEqual(catalogueCache.get('4830010').get('name'), '信息科学技术导论')
+        catalogueCache.expireAt = 0
+        self.assertEqual(catalogueCache.get('4830010').get('name'), '信息科学')
+
+        # 共享缓存的incr不是原子操作时，两次失效可能拿到同一个版本号：其他进程丢弃全部记录
+        shared = caches['default']
+        try:
+            shared.clear()
+            reader = CatalogueCache('default')
+            self.assertEqual(reader.get('4830010').get('name'), '信息科学')
+            Course.objects.filter(course_id='4830010').update(name='信息科学技术')
+            # The other invalidation wrote version 1 but its incr was lost
+            shared.delete(RECORD_KEY.format('4830010'))
+            shared.set(CHANGE_KEY.format(1), ['4830010'])
+            CatalogueCache('default').invalidate(['4831230'])
+            self.assertEqual(shared.get(VERSION_KEY), 2)
+            self.assertEqual(reader.get('4830010').get('name'), '信息科学技术')
+        finally:
+            shared.clear()
+
+        # 删除后不再返回
+        self.client.delete('/course/courses/4830010')
+        respData = self.client.get('/course/courses/4830010/detail')
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.COURSE_404)
+
+    def test_import(self):
+        from .importer import importCourses
+        Time.objects.create(day=1, period=7)
+        crss = [{"course_id": 4830000 + i, "name": "课程{}".format(i), "credit": 2, "main_class": 0,
+                 "sub_class": "A", "times": [{"day": 1 + i % 7, "period": [7, 8]}], "lecturer": "王源",
+                 "pos": "理教201", "dept": 48, "capacity": 100} for i in range(20)]
+
+        # 任何一门课程有错误时不写入任何数据
+        bad = crss + [dict(crss[0], course_id=4839999, times=[{"day": 8, "period": [1]}]), crss[3]]
+        count, errors = importCourses(bad)
+        self.assertEqual(count, 0)
+        self.assertEqual([(e['index'], e['msg']) for e in errors], [(20, ERR_TYPE.PARAM_ERR), (21, ERR_TYPE.COURSE_DUP)])
+        self.assertEqual(Course.objects.count(), 0)
+
+        # 查询次数与课程数量无关
+        with CaptureQueriesContext(connection) as queries:
+            count, errors = importCourses(crss, batchSize=1000)
+        self.assertEqual((count, errors), (20, []))
+        self.assertLessEqual(len(queries), 10)
+        self.assertEqual(Time.objects.count(), 14)
+        c = Course.objects.get(course_id='4830008')
+        self.assertEqual(c.getSlotMask(), slotMask(2, 7) | slotMask(2, 8))
+        self.assertEqual(Course.refreshAllSlotMasks(), 0)
+
+        # 已存在的课程报错；upsert时修改信息和上课时间，不改变选课人数
+        Course.objects.filter(course_id='4830008').update(elect_num=3)
+        count, errors = importCourses([crss[8]])
+        self.assertEqual(errors[0]['msg'], ERR_TYPE.COURSE_DUP)
+        count, errors = importCourses([dict(crss[8], name='新课程', times=[{"day": 3, "period": [1]}])], upsert=True)
+        self.assertEqual(count, 1)
+        c = Course.objects.get(course_id='4830008')
+        self.assertEqual((c.name, c.elect_num, c.getSlotMask()), ('新课程', 3, slotMask(3, 1)))
+        self.assertEqual(list(c.times.values_list('day', 'period')), [(3, 1)])
+        self.assertEqual(courseIndex.search('新课程')[0][0]['course_id'], '4830008')
+
+        # 容量不能小于已选上的人数，有错误时不写入
+        count, errors = importCourses([dict(crss[8], name='课程8', capacity=2)], upsert=True)
+        self.assertEqual((count, [(e['index'], e['msg']) for e in errors]), (0, [(0, ERR_TYPE.PARAM_ERR)]))
+        self.assertEqual(Course.objects.get(course_id='4830008').name, '新课程')
+
+        # 已经有学生选了的课程保留原来的上课时间
+        stu = User.objects.create_user('1700012856', password='123456')
+        Election.objects.create(stu=stu, crs=c, status=ELE_TYPE.ELECTED, willingpoint=1)
+        count, errors = importCourses([dict(crss[8], name='课程8', times=[{"day": 5, "period": [2]}]),
+                                       dict(crss[9], times=[{"day": 5, "period": [2]}])], upsert=True)
+        self.assertEqual((count, errors), (2, []))
+        c = Course.objects.get(course_id='4830008')
+        self.assertEqual((c.name, c.getSlotMask()), ('课程8', slotMask(3, 1)))
+        self.assertEqual(list(c.times.values_list('day', 'period')), [(3, 1)])
+        self.assertEqual(Course.objects.get(course_id='4830009').getSlotMask(), slotMask(5, 2))
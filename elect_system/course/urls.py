@@ -6,6 +6,8 @@ urlpatterns = [
     path('showallcourse', views.show_all_course),  # just for debug
     path('courses', views.course),
     path('depts', views.dept),
+    path('search', views.search),
+    path('cachestats', views.cacheStats),
     re_path(r'courses/(\d{0,})/detail', views.courseDetail),
     re_path(r'courses/(\d{0,})', views.course),
 
@@ -1,14 +1,18 @@
 from election.models import Election
 from course.models import DEPT
 from django.shortcuts import render
-from django.http import HttpResponse, JsonResponse, HttpRequest
+from django.http import HttpResponse, JsonResponse, HttpRequest, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import response
 from django.views.decorators.csrf import csrf_exempt
 import json
 import traceback
 import logging
 import django.contrib.auth as auth
-from course.models import Course, Time
+from course.models import Course, PERIOD_NUM, timesToMask
+from course.search import courseIndex
+from course.cache import catalogueCache, loadRecords
+from course.importer import importCourses
 from elect_system.settings import ERR_TYPE, ELE_TYPE
 from django.db import IntegrityError
 
@@ -23,10 +27,26 @@ def show_all_course(request: HttpRequest):
         return JsonResponse({'success': False, 'msg': 'Please login first', })
     if request.method != 'POST':
         return JsonResponse({'success': False, 'msg': 'Wrong method', })
-    courseList = Course.objects.all()
+    # 支持与课程查询相同的limit、cursor分页
+    limit = request.GET.get('limit')
+    cursor = request.GET.get('cursor')
+    courseList = Course.objects.only('course_id', 'name', 'detail', 'capacity',
+                                     'elect_num', 'elect_newround_num')
+    retDict = {'success': True}
+    try:
+        if limit:
+            limit = min(int(limit), COURSE_PAGE_MAX)
+            if limit <= 0:
+                raise ValueError('Invalid limit {}'.format(limit))
+            courseList = course_page(courseList, cursor, limit)
+            retDict['next_cursor'] = courseList[-1].course_id if len(courseList) == limit else None
+    except:
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
     courseinfo_list = []
     for course in courseList:
         couserInfo = {
+            "course_id": course.course_id,
             "name": course.name,
             "detail": course.detail,
             "capacity": course.capacity,
@@ -34,8 +54,8 @@ def show_all_course(request: HttpRequest):
             "waiting_num": course.elect_newround_num
         }
         courseinfo_list.append(couserInfo)
-
-    return JsonResponse({'success': True, 'msg': courseinfo_list, })
+    retDict['msg'] = courseinfo_list
+    return JsonResponse(retDict)
 
 #对于课程时间格式的验证函数，用来判断课程的时间段是否正确
 def check_time_format(times: list):
@@ -69,13 +89,97 @@ def get_time_json(course: Course):
             }
     return [x for x in json.values()]
 
-#检验学生选课后是否发生时间冲突的函数
-def check_time(course, day, period):
-    times = course.times.all()
-    for time in times:
-        if time.day == day and (time.period in period):
-            return True
-    return False
+# 课程json中可以通过fields参数选择的字段，以及默认返回的字段
+COURSE_FIELDS = ('course_id', 'name', 'credit', 'main_class', 'sub_class', 'times',
+                 'lecturer', 'pos', 'dept', 'name_eng', 'prerequisite', 'detail',
+                 'capacity', 'election')
+COURSE_LIST_FIELDS = ('course_id', 'name', 'credit', 'main_class', 'sub_class', 'times',
+                      'lecturer', 'pos', 'dept', 'election')
+# 分页查询时每页最多的课程数量，以及流式导出时每次从数据库读取的课程数量
+COURSE_PAGE_MAX = 500
+COURSE_STREAM_CHUNK = 1000
+
+#解析fields参数（逗号分隔），缺省时返回默认字段
+def parse_fields(fields: str, allowed: tuple = COURSE_FIELDS, default: tuple = COURSE_LIST_FIELDS):
+    if not fields:
+        return default
+    fields = tuple(f for f in fields.split(',') if f)
+    for f in fields:
+        if f not in allowed:
+            raise ValueError('Unknown field {}'.format(f))
+    return fields
+
+#课程的元数据从目录缓存读取，数据库中只读取选课人数相关的列
+def project_courses(courseSet):
+    return courseSet.only('course_id', 'capacity', 'elect_num', 'elect_newround_num')
+
+#按course_id进行keyset分页，cursor为上一页最后一门课程的id
+def course_page(courseSet, cursor: str, limit: int) -> list:
+    courseSet = courseSet.order_by('course_id')
+    if cursor:
+        courseSet = courseSet.filter(course_id__gt=cursor)
+    return list(courseSet[:limit])
+
+#按相关度分页，rank为{课程id: 名次}，cursor为上一页最后一门课程的id
+def ranked_page(courseSet, rank: dict, cursor: str, limit: int) -> list:
+    crsIds = sorted(courseSet.values_list('course_id', flat=True), key=lambda crsId: rank[crsId])
+    if cursor in rank:
+        crsIds = [crsId for crsId in crsIds if rank[crsId] > rank[cursor]]
+    crsIds = crsIds[:limit]
+    courses = {course.course_id: course for course in courseSet.filter(course_id__in=crsIds)}
+    return [courses[crsId] for crsId in crsIds if crsId in courses]
+
+#课程在列表中的json表示，record为目录缓存中的课程记录，st和wp为当前学生对该课程的选课状态和意愿点
+def get_course_json(record: dict, course: Course, st: int = 0, wp: int = 0,
+                    fields: tuple = COURSE_LIST_FIELDS):
+    course_json = {}
+    for f in fields:
+        if f == 'election':
+            course_json['election'] = {
+                "status": st,
+                "willingpoint": wp,
+                "elected_num": course.elect_num,
+                "capacity": course.capacity,
+                "pending_num": course.elect_newround_num
+            }
+        else:
+            course_json[f] = record[f]
+    return course_json
+
+#将一页课程转换为json列表，课程记录一次性从目录缓存中批量读取
+def get_course_json_list(courses: list, stuElections: dict, fields: tuple, records: dict = None) -> list:
+    if records is None:
+        records = catalogueCache.getMany([course.course_id for course in courses])
+    return [get_course_json(records[course.course_id], course,
+                            *stuElections.get(course.course_id, (0, 0)), fields=fields)
+            for course in courses if course.course_id in records]
+
+#流式输出课程列表，每次只在内存中保留一批课程
+#（导出整个目录时不经过目录缓存，直接从数据库读取记录，避免把全部课程留在缓存中）
+def stream_course_list(courseSet, fields: tuple, stuElections: dict):
+    yield '{"success": true, "course_list": ['
+    cursor, sep = None, ''
+    while True:
+        page = course_page(courseSet, cursor, COURSE_STREAM_CHUNK)
+        records = loadRecords([course.course_id for course in page])
+        for course_json in get_course_json_list(page, stuElections, fields, records):
+            yield sep + json.dumps(course_json, cls=DjangoJSONEncoder)
+            sep = ','
+        if len(page) < COURSE_STREAM_CHUNK:
+            break
+        cursor = page[-1].course_id
+    yield ']}'
+
+#将查询参数中的day和period（逗号分隔，缺省时表示一整天）转换为时间位图
+def parse_slot_mask(day: str, period: str) -> int:
+    day = int(day)
+    if period:
+        periods = [int(x) for x in period.split(',')]
+    else:
+        periods = range(1, PERIOD_NUM + 1)
+    if not check_time_format([{'day': day, 'period': list(periods)}]):
+        raise ValueError('Invalid time slot: day={}, period={}'.format(day, period))
+    return timesToMask((day, p) for p in periods)
 
 
 @csrf_exempt
@@ -99,85 +203,16 @@ def course(request: HttpRequest, crsIdInURL: str = ''):
             logging.error('courses param err, req={}'.format(reqData))
             return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
 
-        for crs in crss:
-            courseId = crs.get('course_id')
-            name = crs.get('name')
-            credit = crs.get('credit')
-            lecturer = crs.get('lecturer')
-            pos = crs.get('pos')
-            dept = crs.get('dept')
-
-            name_eng = crs.get('name_eng')
-            prerequisite = crs.get('prerequisite')
-            detail = crs.get('detail')
-            main_class = crs.get('main_class')
-            sub_class = crs.get('sub_class')
-            times = crs.get('times')
-            capacity = crs.get('capacity')
-
-            try:
-                courseId = str(courseId)
-                name = str(name)
-                credit = int(credit)
-                dept = int(dept)
-                main_class = int(main_class)
-                capacity = int(capacity)
-            except:
-                traceback.print_exc()
-                logging.error(
-                    'Create course param type error, crs={}'.format(crs))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-            #对欲添加课程时间的格式进行检查
-            if not isinstance(times, list):
-                logging.error('Course time format err, times={}'.format(times))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-            
-            if not check_time_format(times):
-                logging.error('Course time format err, times={}'.format(times))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-
-            # 如果当前想要添加的课程id已经在列表中存在（实际上也就是不支持课号一样的课程，与北大选课网有所区别）
-            if Course.objects.filter(course_id=courseId).exists():
-                logging.error(
-                    'Cannot add for course already exist, crsId={}'.format(courseId))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.COURSE_DUP})
-
-            c = Course.objects.create(course_id=courseId, name=name, credit=credit,
-                                      lecturer=lecturer, pos=pos, dept=dept,
-                                      main_class=main_class, sub_class=sub_class,
-                                      name_eng=name_eng, prerequisite=prerequisite,
-                                      detail=detail, capacity=capacity)
-
-            for tim in times:
-                day = tim.get('day')
-                periods = tim.get('period')
-                if not isinstance(day, int) or \
-                        not isinstance(periods, list):
-                    logging.error(
-                        'Time field error, error time={}'.format(times))
-                    return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-                for period in periods:
-                    tSet = Time.objects.filter(day=day, period=period)
-                    try:
-                        if tSet.exists():
-                            t = tSet[0]
-                            c.times.add(t)
-                        else:
-                            t = Time.objects.create(day=day, period=period)
-                            t.save()
-                            c.times.add(t)
-                    except:
-                        traceback.print_exc()
-                        logging.error('Unknown err 8086')
-                        return JsonResponse({'success': False, 'msg': ERR_TYPE.UNKNOWN})
-            try:
-                c.save()
-            except:
-                traceback.print_exc()
-                logging.error('Unknown err 8087')
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.UNKNOWN})
-
-        return JsonResponse({'success': True})
+        # upsert为True时修改已存在的课程，否则已存在的课程报COURSE_DUP；任何一门课程有错误时不写入
+        try:
+            created, errors = importCourses(crss, upsert=bool(reqData.get('upsert')))
+        except IntegrityError:
+            traceback.print_exc()
+            logging.error('Unknown err 8086')
+            return JsonResponse({'success': False, 'msg': ERR_TYPE.UNKNOWN})
+        if errors:
+            return JsonResponse({'success': False, 'msg': errors[0]['msg'], 'errors': errors})
+        return JsonResponse({'success': True, 'count': created})
     #通过GET请求来获取满足查询条件的课程列表
     elif request.method == 'GET':
         # 这里如果在request结构体中没有填写课程的某些属性作为查询条件，则返回空字符串
@@ -188,54 +223,78 @@ def course(request: HttpRequest, crsIdInURL: str = ''):
         name = request.GET.get('name')
         main_class = request.GET.get('main_class')
         sub_class = request.GET.get('sub_class')
+        # free=1：只返回与当前学生已选课程没有时间冲突的课程
+        free = request.GET.get('free')
+        # 分页（limit、cursor）、字段选择（fields）以及教务导出用的流式输出（stream=1）
+        limit = request.GET.get('limit')
+        cursor = request.GET.get('cursor')
+        stream = request.GET.get('stream')
+        try:
+            fields = parse_fields(request.GET.get('fields'))
+            if limit:
+                limit = min(int(limit), COURSE_PAGE_MAX)
+                if limit <= 0:
+                    raise ValueError('Invalid limit {}'.format(limit))
+        except:
+            traceback.print_exc()
+            logging.error('Search param err, fields={}, limit={}'.format(
+                request.GET.get('fields'), limit))
+            return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
+        if stream and not request.user.is_superuser:
+            logging.error('user export courses without privilege')
+            return JsonResponse({'success': False, 'msg': ERR_TYPE.NOT_ALLOWED})
 
         if crsIdInURL != '':
             crsId = crsIdInURL
         #依照搜寻条件依次进行层次查询
-        course_list = Course.objects.all()
+        course_list = project_courses(Course.objects.all())
         if crsId:
             course_list = course_list.filter(course_id=crsId)
         if dept:
             course_list = course_list.filter(dept=dept)
+        # 课程名称等支持前缀、子串以及拼音首字母匹配，结果按相关度排序
+        rank = None
         if name:
-            course_list = course_list.filter(name=name)
+            rank = {display['course_id']: i for i, (display, score) in enumerate(courseIndex.search(name))}
+            course_list = course_list.filter(course_id__in=list(rank))
         if main_class:
             course_list = course_list.filter(main_class=main_class)
         if sub_class:
             course_list = course_list.filter(sub_class=sub_class)
-        if day and period:
-            day = int(day)
-            period = [int(x) for x in period.split(',')]
-            course_list = [
-                x for x in course_list if check_time(x, day, period)]
-
-        course_json_list = []
-        for course in course_list:
-            elected, pending = Election.getCourseElecionNum(course.course_id)
-            st, wp = 0, 0
-            if request.user.is_authenticated:
-                st, wp = Election.getStuElectionNum(
-                    request.user.username, course.course_id)
-            course_json = {
-                "course_id": course.course_id,
-                "name": course.name,
-                "credit": course.credit,
-                "main_class": course.main_class,
-                "sub_class": course.sub_class,
-                "times": get_time_json(course),
-                "lecturer": course.lecturer,
-                "pos": course.pos,
-                "dept": course.dept,
-                "election": {
-                    "status": st,
-                    "willingpoint": wp,
-                    "elected_num": elected,
-                    "capacity": course.capacity,
-                    "pending_num": pending
-                }
-            }
-            course_json_list.append(course_json)
-        return JsonResponse({'success': True, 'course_list': course_json_list})
+        # 时间筛选通过课程的时间位图在数据库中完成
+        if day:
+            try:
+                slotMask = parse_slot_mask(day, period)
+            except:
+                traceback.print_exc()
+                logging.error('Search time param err, day={}, period={}'.format(day, period))
+                return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
+            course_list = Course.filterSlotsAny(course_list, slotMask)
+        if free and request.user.is_authenticated:
+            course_list = Course.filterSlotsFree(
+                course_list, Election.getSlotMaskOfStudent(request.user.username))
+
+        # 当前学生的所有选课记录只查询一次，按课程id索引
+        stuElections = {}
+        if request.user.is_authenticated and 'election' in fields:
+            stuElections = Election.getStuElections(request.user.username)
+
+        if stream:
+            return StreamingHttpResponse(stream_course_list(course_list, fields, stuElections),
+                                         content_type='application/json')
+
+        retDict = {'success': True}
+        if limit:
+            # 按名称查询时按相关度分页，否则按课程id分页
+            if rank is not None:
+                course_list = ranked_page(course_list, rank, cursor, limit)
+            else:
+                course_list = course_page(course_list, cursor, limit)
+            retDict['next_cursor'] = course_list[-1].course_id if len(course_list) == limit else None
+        elif rank is not None:
+            course_list = sorted(course_list, key=lambda c: rank[c.course_id])
+        retDict['course_list'] = get_course_json_list(list(course_list), stuElections, fields)
+        return JsonResponse(retDict)
 
     # 编辑课程的相关信息，采用PUT的请求方式
     elif request.method == 'PUT':
@@ -306,23 +365,33 @@ def course(request: HttpRequest, crsIdInURL: str = ''):
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.COURSE_404})
             c = crsSet.get()
 
+            # 只写回修改的列，选课计数器和时间位图由选课/抽签在事务中维护，不能用读出的旧值覆盖
+            edited = []
             if name:
                 c.name = name
+                edited.append('name')
             if credit:
                 c.credit = credit
+                edited.append('credit')
             if dept:
                 c.dept = dept
+                edited.append('dept')
             if main_class:
                 c.main_class = main_class
+                edited.append('main_class')
 
             if capacity:
                 if capacity >= c.capacity:
                     c.capacity = capacity
+                    edited.append('capacity')
                 else:
                     logging.warn(
                         'Cannot decrease course capacity, {}->{}'.format(c.capacity, capacity))
                     return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-            c.save()
+            if edited:
+                c.save(update_fields=edited)
+            catalogueCache.invalidate([c.course_id])
+            courseIndex.update(c)
         return JsonResponse({'success': True})
 
     # 用DELETE类型的请求来删除一个课程
@@ -339,6 +408,8 @@ def course(request: HttpRequest, crsIdInURL: str = ''):
             logging.error(
                 'Cannot delete courses with students elected or pending, crsId={}'.format(crsIdInURL))
             return JsonResponse({'success': False, 'msg': ERR_TYPE.HOT_EDIT})
+        catalogueCache.invalidate([crsIdInURL])
+        courseIndex.remove(crsIdInURL)
 
         return JsonResponse({'success': True})
 
@@ -346,43 +417,38 @@ def course(request: HttpRequest, crsIdInURL: str = ''):
         logging.error('invalid method: {}'.format(request.method))
         return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
 
+#只通过进程内索引搜索课程（名称、英文名、教师、课程号的前缀/子串/拼音首字母），不访问数据库
+@csrf_exempt
+def search(request: HttpRequest):
+    if request.method != 'GET':
+        logging.error('invalid method: {}'.format(request.method))
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
+    q = request.GET.get('q')
+    limit = request.GET.get('limit')
+    try:
+        limit = min(int(limit), COURSE_PAGE_MAX) if limit else 20
+    except:
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
+    hits = courseIndex.search(q, limit)
+    return JsonResponse({'success': True, 'data': [dict(display, score=score) for display, score in hits]})
+
 #查看课程详细信息的函数（主要用于前端交互功能：点击选课列表中已选课程来查看该课程的详细信息）
 @csrf_exempt
 def courseDetail(request: HttpRequest, course_id: str = ''):
     if request.method == 'GET':
-        try:
-            course = Course.objects.get(course_id=course_id)
-            def get_time_json(course):
-                times = course.times.all()
-                json = {}
-                for time in times:
-                    day = time.day
-                    period = time.period
-                    if json.get(day):
-                        json[day]["period"].append(period)
-                    else:
-                        json[day] = {
-                            "day": day,
-                            "period": [period]
-                        }
-                return [x for x in json.values()]
-            course_json = {
-                "course_id": course.course_id,
-                "name": course.name,
-                "credit": course.credit,
-                "main_class": course.main_class,
-                "sub_class": course.sub_class,
-                "times": get_time_json(course),
-                "lecturer": course.lecturer,
-                "pos": course.pos,
-                "dept": course.dept,
-                "name_eng": course.name_eng,
-                "prerequisite": course.prerequisite,
-                "detail": course.detail,
-                "capacity": course.capacity,
-            }
-            return JsonResponse(course_json)
-        except:
+        course_json = catalogueCache.get(course_id)
+        if course_json is None:
             return JsonResponse({'success': False, 'msg': ERR_TYPE.COURSE_404})
+        return JsonResponse(course_json)
     else:
-        JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
+
+
+#目录缓存的命中统计，仅教务可以查看
+@csrf_exempt
+def cacheStats(request: HttpRequest):
+    if not request.user.is_superuser:
+        logging.error('user get cache stats without privilege')
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.NOT_ALLOWED})
+    return JsonResponse({'success': True, 'data': catalogueCache.stats()})
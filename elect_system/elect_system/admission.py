@@ -0,0 +1,211 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpRequest
+from elect_system.settings import ADMISSION, ERR_TYPE
+
+'''
+选课高峰期的准入控制
+
+对settings.ADMISSION['PATHS']中的接口限制同时处理的请求数：
+    MAX_IN_FLIGHT：同时处理的请求数上限，超出的请求按到达顺序排队（FIFO）
+    MAX_QUEUE：排队的请求数上限，队列已满时立即返回429
+    MAX_WAIT：排队的最长时间（秒），超时返回429
+    PER_USER：同一用户处理中和排队中的请求数上限，避免单个用户占满队列
+    RETRY_AFTER：429响应的Retry-After头（秒）
+限制作用于单个worker进程内，总并发为MAX_IN_FLIGHT乘以worker数。
+中间件同时支持同步和异步调用：ASGI下排队的请求在事件循环中等待，不占用线程，
+也不会让Django把整个中间件链放到同一个同步线程中执行（长轮询等异步视图因此不会阻塞其他请求）。
+'''
+
+
+# 异步请求的排队凭证，接口与threading.Event相同，set可以在任意线程中调用
+class AsyncWaiter:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.flag = False
+
+    def set(self):
+        self.flag = True
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+    def is_set(self) -> bool:
+        return self.flag
+
+
+class AdmissionController:
+    def __init__(self, maxInFlight: int, maxQueue: int, maxWait: float, perUser: int):
+        self.maxInFlight = maxInFlight
+        self.maxQueue = maxQueue
+        self.maxWait = maxWait
+        self.perUser = perUser
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        # Waiting requests in arrival order, a released slot is handed to the head
+        self.queue = deque()
+        self.userCnt = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.queued = 0
+        self.maxDepth = 0
+        self.totalWait = 0.0
+        self.maxWaitSeen = 0.0
+
+    def _take(self, key: str):
+        self.userCnt[key] = self.userCnt.get(key, 0) + 1
+
+    def _drop(self, key: str):
+        cnt = self.userCnt.get(key, 0) - 1
+        if cnt > 0:
+            self.userCnt[key] = cnt
+        else:
+            self.userCnt.pop(key, None)
+
+    # 立即得到名额或被拒绝时返回True/False，需要排队时返回排队凭证
+    def _enter(self, key: str, waiterType):
+        with self.lock:
+            if self.userCnt.get(key, 0) >= self.perUser:
+                self.rejected += 1
+                return False
+            if self.inFlight < self.maxInFlight and not self.queue:
+                self.inFlight += 1
+                self._take(key)
+                self.admitted += 1
+                return True
+            if len(self.queue) >= self.maxQueue:
+                self.rejected += 1
+                return False
+            ev = waiterType()
+            self.queue.append(ev)
+            self._take(key)
+            self.queued += 1
+            self.maxDepth = max(self.maxDepth, len(self.queue))
+            return ev
+
+    # 申请一个处理名额，成功返回True，之后必须调用release
+    def acquire(self, key: str) -> bool:
+        ev = self._enter(key, threading.Event)
+        if isinstance(ev, bool):
+            return ev
+        startTime = time.time()
+        ev.wait(self.maxWait)
+        return self._leave(key, ev, time.time() - startTime)
+
+    # acquire的异步版本，排队时在事件循环中等待
+    async def acquireAsync(self, key: str) -> bool:
+        ev = self._enter(key, AsyncWaiter)
+        if isinstance(ev, bool):
+            return ev
+        startTime = time.time()
+        await asyncio.wait([ev.future], timeout=self.maxWait)
+        return self._leave(key, ev, time.time() - startTime)
+
+    def _leave(self, key: str, ev, waited: float) -> bool:
+        with self.lock:
+            self.totalWait += waited
+            self.maxWaitSeen = max(self.maxWaitSeen, waited)
+            # The slot may have been handed over right after the timeout
+            if ev.is_set():
+                self.admitted += 1
+                return True
+            self.queue.remove(ev)
+            self._drop(key)
+            self.timeouts += 1
+            self.rejected += 1
+            return False
+
+    def release(self, key: str):
+        with self.lock:
+            self._drop(key)
+            if self.queue:
+                # Hand the slot over, inFlight stays the same
+                self.queue.popleft().set()
+            else:
+                self.inFlight -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'in_flight': self.inFlight,
+                'queue_depth': len(self.queue),
+                'max_queue_depth': self.maxDepth,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'queued': self.queued,
+                'avg_wait': self.totalWait / self.queued if self.queued else 0.0,
+                'max_wait': self.maxWaitSeen,
+            }
+
+
+admission = AdmissionController(ADMISSION['MAX_IN_FLIGHT'], ADMISSION['MAX_QUEUE'],
+                                ADMISSION['MAX_WAIT'], ADMISSION['PER_USER'])
+
+
+def admissionKey(request: HttpRequest) -> str:
+    if request.user.is_authenticated:
+        return request.user.username
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def busyResponse(key: str, request: HttpRequest):
+    logging.warn('Request rejected by admission control, key={}, path={}'.format(key, request.path))
+    response = JsonResponse({'success': False, 'msg': ERR_TYPE.BUSY}, status=429)
+    response['Retry-After'] = str(ADMISSION['RETRY_AFTER'])
+    return response
+
+
+class AdmissionMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.isAsync = asyncio.iscoroutinefunction(get_response)
+        if self.isAsync:
+            # Lets Django call this middleware without a sync adapter
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request: HttpRequest):
+        if self.isAsync:
+            return self.__acall__(request)
+        if not request.path.startswith(tuple(ADMISSION['PATHS'])):
+            return self.get_response(request)
+
+        key = admissionKey(request)
+        if not admission.acquire(key):
+            return busyResponse(key, request)
+        try:
+            return self.get_response(request)
+        finally:
+            admission.release(key)
+
+    async def __acall__(self, request: HttpRequest):
+        if not request.path.startswith(tuple(ADMISSION['PATHS'])):
+            return await self.get_response(request)
+
+        # Loading the user reads the session from the database
+        key = await sync_to_async(admissionKey)(request)
+        if not await admission.acquireAsync(key):
+            return busyResponse(key, request)
+        try:
+            return await self.get_response(request)
+        finally:
+            admission.release(key)
+
+
+#准入控制的队列统计，仅教务可以查看
+def admissionStats(request: HttpRequest):
+    if not request.user.is_superuser:
+        logging.error('user get admission stats without privilege')
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.NOT_ALLOWED})
+    return JsonResponse({'success': True, 'data': admission.stats()})
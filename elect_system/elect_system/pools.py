@@ -0,0 +1,25 @@
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+进程内共用的进程池
+
+批量导入的密码哈希、抽签的分片排序等CPU密集的计算放到进程池中。spawn方式启动的子进程要重新import整个项目，
+每个请求创建、关闭一次进程池的开销与计算本身相当，同时进行的多个导入还会各自启动一组进程。
+这里每种大小的进程池在第一次需要时创建，之后在本进程内复用，同时进行的请求共用其中的子进程。
+'''
+
+_lock = threading.Lock()
+# workers -> ProcessPoolExecutor
+_pools = {}
+
+
+def getPool(workers: int) -> ProcessPoolExecutor:
+    with _lock:
+        pool = _pools.get(workers)
+        # A pool whose child died cannot take new work, start a new one
+        if pool is None or pool._broken:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pools[workers] = pool
+        return pool
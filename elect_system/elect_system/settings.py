@@ -56,6 +56,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware', 
+    'elect_system.admission.AdmissionMiddleware',
 ]
 
 CORS_ALLOW_CREDENTIALS = True
@@ -225,6 +226,75 @@ EMAIL_HOST_PASSWORD = 'xxxxxxxx'
 
 DEFAULT_CHARSET = 'utf-8'
 
+# Number of worker processes used to rank courses during the ballot,
+# 1 means the ballot runs in the scheduler thread
+BALLOT_WORKERS = 1
+
+# Bulk student import (see user/importer.py): WORKERS processes hash the
+# passwords (1 hashes in the calling thread), CHUNK rows are inserted per
+# transaction. The pool is started by the first import and shared by all
+# later and concurrent imports of the worker process (elect_system/pools.py)
+STU_IMPORT = {
+    'WORKERS': 4,
+    'CHUNK': 500,
+}
+
+# Rows per INSERT of the bulk course import (see course/importer.py)
+COURSE_IMPORT_BATCH = 1000
+
+# Alias of the django cache shared by all workers for the course catalogue
+# cache (see course/cache.py), e.g. a FileBasedCache added to CACHES.
+# None keeps the catalogue cache in process memory only, which is meant for a
+# single worker: changes made through another worker show up only after the
+# local copy expires (CATALOGUE_LOCAL_TTL seconds). Set an alias when running
+# several workers. Prefer a backend with an atomic incr (Redis, Memcached):
+# FileBasedCache's incr is read-modify-write, two concurrent invalidations may
+# get the same version, and every worker then drops its whole local copy.
+CATALOGUE_CACHE = None
+CATALOGUE_LOCAL_TTL = 60
+
+# How the elect endpoint serializes the requests of one student:
+#   'row': lock the student row with SELECT ... FOR UPDATE inside a transaction,
+#          works with any number of worker processes
+#   'local': the in-process stuLock dict, only safe with a single process
+ELECT_LOCK_MODE = 'row'
+
+# Number of in-process locks shared by all students in 'local' mode
+STU_LOCK_STRIPES = 1024
+
+# Replay of elect/batch responses for client retries carrying the same
+# request_id (see election/idempotency.py). CACHE is a django cache alias
+# shared by all workers, None keeps the entries in process memory. WAIT is how
+# long a retry waits for the original request that is still in flight.
+ELECT_REPLAY = {
+    'CACHE': None,
+    'TTL': 120,
+    'MAX_SIZE': 100000,
+    'WAIT': 5,
+}
+
+# Long-poll notifications of new messages and election open/close (see
+# user/notify.py). CACHE is a django cache alias shared by all workers,
+# None keeps the version counter in process memory and other processes'
+# changes are found by re-reading the database every RECHECK seconds.
+NOTIFY = {
+    'CACHE': None,
+    'TIMEOUT': 30,
+    'INTERVAL': 0.5,
+    'RECHECK': 10,
+}
+
+# Admission control in front of the busiest endpoints, per worker process
+# (see elect_system/admission.py)
+ADMISSION = {
+    'PATHS': ['/election/elect', '/election/batch', '/course/courses'],
+    'MAX_IN_FLIGHT': 16,
+    'MAX_QUEUE': 256,
+    'MAX_WAIT': 3.0,
+    'PER_USER': 2,
+    'RETRY_AFTER': 1,
+}
+
 
 class ERR_TYPE:
     INVALID_METHOD = 'Invalid method'
@@ -245,6 +315,9 @@ class ERR_TYPE:
     TIME_CONF = 'Course time conflict'
     UNKNOWN = "Unknown error"
     MSG_404 = 'This message id doesn\'t exist'
+    BATCH_FAIL = 'Some operations in the batch failed, nothing is changed'
+    BATCH_LIMIT = 'Too many operations in one batch'
+    BUSY = 'Server is busy, please retry later'
 
     HOT_EDIT = "Hot edit is not allowed"
     GT_ONE = 'Addition number greater than one'
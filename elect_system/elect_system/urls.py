@@ -15,11 +15,13 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from .admission import admissionStats
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('user/', include('user.urls')),
     path('course/', include('course.urls')),
     path('election/', include('election.urls')),
-    path('phase/', include('phase.urls'))
+    path('phase/', include('phase.urls')),
+    path('admission/stats', admissionStats),
 ]
@@ -0,0 +1,161 @@
+import logging
+from django.db import transaction
+from django.db.models import F
+from .models import Election, WP_STATUS
+from user.models import User
+from course.models import Course
+from elect_system.settings import ELE_TYPE, ERR_TYPE, OP_TYPE
+
+'''
+批量选课
+
+一个请求中的多个操作（type与elect接口相同，见OP_TYPE）依次在同一份内存快照上校验：
+    快照：Election.getElectSnapshot两次索引查询得到的课程和该学生的选课，以及学生的学分和意愿点额度
+    校验：每个操作修改内存中的选课状态，后面的操作看到前面操作的结果
+    写回：全部操作通过后，比较快照的初始状态与最终状态，在一个事务中批量写回；
+         任一操作失败时不写入任何数据
+'''
+
+# Max number of operations in one batch request
+BATCH_MAX_OPS = 50
+
+
+# 该学生所有选课时间位图的并集
+def slotMaskOf(elections: dict, courses: dict) -> int:
+    mask = 0
+    for crsId in elections:
+        mask |= courses[crsId][1]
+    return mask
+
+
+# 返回(typeId, courseId, wp)，格式错误时返回None
+def parseOp(op):
+    if type(op) is not dict:
+        return None
+    wp = op.get('willingpoint')
+    try:
+        typeId = int(op.get('type'))
+        courseId = str(op.get('course_id'))
+        wp = int(wp) if wp else 0
+    except:
+        return None
+    if wp < 0:
+        return None
+    return typeId, courseId, wp
+
+
+# 在内存中执行一个操作，成功时修改elections和acct并返回None，失败时返回错误信息
+#   acct：学生的额度，{'credit', 'creditLimit', 'wp', 'wpLimit'}
+def applyOp(op, courses: dict, elections: dict, acct: dict):
+    typeId, courseId, wp = op
+    if typeId == OP_TYPE.ELECT:
+        if courseId not in courses:
+            return ERR_TYPE.COURSE_404
+        if courseId in elections:
+            return ERR_TYPE.ELE_DUP
+        if acct['wp'] + wp > acct['wpLimit']:
+            return ERR_TYPE.WP_ERR
+        credit, crsMask = courses[courseId]
+        if crsMask & slotMaskOf(elections, courses):
+            return ERR_TYPE.TIME_CONF
+        if acct['credit'] + credit > acct['creditLimit']:
+            return ERR_TYPE.CRED_ERR
+        elections[courseId] = (ELE_TYPE.PENDING, wp)
+        acct['credit'] += credit
+        acct['wp'] += wp
+        return None
+
+    elif typeId == OP_TYPE.EDIT_WP:
+        if courseId not in elections:
+            return ERR_TYPE.ELE_404
+        status, oldWp = elections[courseId]
+        if status in WP_STATUS:
+            if acct['wp'] - oldWp + wp > acct['wpLimit']:
+                return ERR_TYPE.WP_ERR
+            acct['wp'] += wp - oldWp
+        elections[courseId] = (status, wp)
+        return None
+
+    elif typeId in (OP_TYPE.QUIT_PEDING, OP_TYPE.DROP):
+        if courseId not in elections:
+            return ERR_TYPE.ELE_404
+        expected = ELE_TYPE.PENDING if typeId == OP_TYPE.QUIT_PEDING else ELE_TYPE.ELECTED
+        status, oldWp = elections[courseId]
+        if status != expected:
+            return ERR_TYPE.ELE_FAIL
+        del elections[courseId]
+        acct['credit'] -= courses[courseId][0]
+        acct['wp'] -= oldWp
+        return None
+
+    return ERR_TYPE.PARAM_ERR
+
+
+def counterOf(status) -> tuple:
+    if status in (ELE_TYPE.ELECTED, ELE_TYPE.NEW_ELECTED):
+        return 1, 0
+    if status == ELE_TYPE.PENDING:
+        return 0, 1
+    return 0, 0
+
+
+# 比较初始和最终的选课状态，在一个事务中写回
+def writeDiff(stuPk: int, courses: dict, before: dict, after: dict, creditDelta: int, wpDelta: int):
+    deleted, created, wpChanged = [], [], {}
+    counters = {}
+    for crsId in set(before) | set(after):
+        old, new = before.get(crsId), after.get(crsId)
+        if old == new:
+            continue
+        if old is not None and new is not None and old[0] == new[0]:
+            wpChanged.setdefault(new[1], []).append(crsId)
+            continue
+        if old is not None:
+            deleted.append(crsId)
+        if new is not None:
+            created.append(crsId)
+        oldCnt = counterOf(old[0] if old else None)
+        newCnt = counterOf(new[0] if new else None)
+        counters[crsId] = (newCnt[0] - oldCnt[0], newCnt[1] - oldCnt[1])
+
+    with transaction.atomic():
+        if creditDelta or wpDelta:
+            User.objects.filter(pk=stuPk).update(
+                curCredit=F('curCredit') + creditDelta, curWp=F('curWp') + wpDelta)
+        if deleted:
+            Election.objects.filter(stu_id=stuPk, crs_id__in=deleted).delete()
+        if created:
+            Election.objects.bulk_create([
+                Election(stu_id=stuPk, crs_id=crsId, credit=courses[crsId][0],
+                         status=after[crsId][0], willingpoint=after[crsId][1])
+                for crsId in created])
+        for wp, crsIds in wpChanged.items():
+            Election.objects.filter(stu_id=stuPk, crs_id__in=crsIds).update(willingpoint=wp)
+        for crsId, (elected, pending) in counters.items():
+            if elected or pending:
+                Course.bumpElectionCounters(crsId, elected=elected, pending=pending)
+
+
+# 校验并执行一批操作，需要持有该学生的锁，返回(是否全部成功, 每个操作的结果)
+def runBatch(stuPk: int, ops: list):
+    parsed = [parseOp(op) for op in ops]
+    courses, before = Election.getElectSnapshot(stuPk, [op[1] for op in parsed if op is not None])
+    curCredit, creditLimit, curWp, wpLimit = User.objects.filter(pk=stuPk).values_list(
+        'curCredit', 'creditLimit', 'curWp', 'willingpointLimit').get()
+
+    after = dict(before)
+    acct = {'credit': curCredit, 'creditLimit': creditLimit, 'wp': curWp, 'wpLimit': wpLimit}
+    results = []
+    for op in parsed:
+        if op is None:
+            err = ERR_TYPE.PARAM_ERR
+        else:
+            err = applyOp(op, courses, after, acct)
+        results.append({'success': False, 'msg': err} if err else {'success': True})
+
+    ok = all(r['success'] for r in results)
+    if ok:
+        writeDiff(stuPk, courses, before, after, acct['credit'] - curCredit, acct['wp'] - curWp)
+    else:
+        logging.warn('Batch election rejected, stu={}, results={}'.format(stuPk, results))
+    return ok, results
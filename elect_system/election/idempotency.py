@@ -0,0 +1,166 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse, HttpRequest
+from elect_system.settings import ELECT_REPLAY, ERR_TYPE
+
+'''
+选课请求的幂等处理
+
+客户端在请求中带上request_id时，第一次处理的响应按(学生, 接口, request_id)保存ELECT_REPLAY['TTL']秒，
+超时重试的相同请求直接返回保存的响应，不再访问数据库：
+重试的选课不会得到ELE_DUP，重试的退课也不会得到ELE_404。
+ELECT_REPLAY['CACHE']为None时保存在进程内（最多MAX_SIZE条）；设置为django缓存的别名时
+在各worker之间共享，重试的请求落到其他worker上也能命中。
+第一次请求在处理前先占住key（PENDING），处理期间到达的重试最多等待ELECT_REPLAY['WAIT']秒后
+重放第一次的响应，不会再次执行。只保存成功或确定被拒绝的响应，PHASE_ERR等暂时性的错误
+不保存，重试时重新处理。
+'''
+
+REPLAY_KEY = 'elect:replay:{}'
+# Marker of a request that is still being processed, it expires in case the
+# worker dies before storing the response
+PENDING = b'__pending__'
+PENDING_TTL = 30
+# Interval at which a retry checks whether the original request has finished
+WAIT_INTERVAL = 0.05
+# Rejections that a retry would get again, the response is replayed
+FINAL_ERRORS = (ERR_TYPE.JSON_ERR, ERR_TYPE.PARAM_ERR, ERR_TYPE.ELE_DUP, ERR_TYPE.ELE_404,
+                ERR_TYPE.COURSE_404, ERR_TYPE.WP_ERR, ERR_TYPE.CRED_ERR, ERR_TYPE.TIME_CONF,
+                ERR_TYPE.BATCH_FAIL, ERR_TYPE.BATCH_LIMIT)
+
+
+class ReplayCache:
+    def __init__(self, alias: str, ttl: int, maxSize: int):
+        self.alias = alias
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        # key -> (expire time, response content), oldest first
+        self.entries = OrderedDict()
+        self.hits = 0
+
+    # 返回保存的响应、PENDING或None
+    def get(self, key: str):
+        if self.alias is not None:
+            content = caches[self.alias].get(REPLAY_KEY.format(key))
+        else:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] < time.time():
+                    del self.entries[key]
+                    entry = None
+                content = entry[1] if entry is not None else None
+        if content is not None and content != PENDING:
+            with self.lock:
+                self.hits += 1
+        return content
+
+    # 占住key，已经有保存的响应或正在处理的请求时返回False
+    def reserve(self, key: str) -> bool:
+        if self.alias is not None:
+            return caches[self.alias].add(REPLAY_KEY.format(key), PENDING, PENDING_TTL)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= now:
+                return False
+            self.entries.pop(key, None)
+            self.entries[key] = (now + PENDING_TTL, PENDING)
+            return True
+
+    # 响应不保存时释放占住的key
+    def release(self, key: str):
+        if self.alias is not None:
+            cache = caches[self.alias]
+            if cache.get(REPLAY_KEY.format(key)) == PENDING:
+                cache.delete(REPLAY_KEY.format(key))
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == PENDING:
+                del self.entries[key]
+
+    def put(self, key: str, content: bytes):
+        if self.alias is not None:
+            caches[self.alias].set(REPLAY_KEY.format(key), content, self.ttl)
+            return
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + self.ttl, content)
+            # Entries are appended in time order, expired ones are at the front
+            while self.entries:
+                oldKey, (expire, oldContent) = next(iter(self.entries.items()))
+                if expire >= now and len(self.entries) <= self.maxSize:
+                    break
+                del self.entries[oldKey]
+
+    def reset(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.hits = 0
+
+
+replayCache = ReplayCache(ELECT_REPLAY['CACHE'], ELECT_REPLAY['TTL'], ELECT_REPLAY['MAX_SIZE'])
+
+
+def requestIdOf(request: HttpRequest):
+    if request.method != 'POST' or not request.user.is_authenticated:
+        return None
+    try:
+        requestId = json.loads(request.body.decode()).get('request_id')
+    except:
+        return None
+    if type(requestId) not in (str, int) or requestId == '':
+        return None
+    # The same request_id sent to elect and batch are two different requests
+    return '{}:{}:{}'.format(request.user.username, request.path, requestId)
+
+
+# 成功或确定被拒绝的响应才保存
+def isFinal(response) -> bool:
+    if response.status_code != 200:
+        return False
+    try:
+        data = json.loads(response.content.decode())
+    except:
+        return False
+    return data.get('success') is True or data.get('msg') in FINAL_ERRORS
+
+
+# 视图装饰器，带request_id的请求按(学生, request_id)保存并重放响应
+def idempotent(view):
+    @wraps(view)
+    def wrapper(request: HttpRequest, *args, **kwargs):
+        key = requestIdOf(request)
+        if key is None:
+            return view(request, *args, **kwargs)
+        deadline = time.time() + ELECT_REPLAY['WAIT']
+        while True:
+            content = replayCache.get(key)
+            if content is None and replayCache.reserve(key):
+                break
+            if content is not None and content != PENDING:
+                logging.info('Replay election response, key={}'.format(key))
+                return HttpResponse(content, content_type='application/json')
+            # The original request is still in flight
+            if time.time() >= deadline:
+                logging.warn('Retry gave up waiting for the original request, key={}'.format(key))
+                return JsonResponse({'success': False, 'msg': ERR_TYPE.BUSY})
+            time.sleep(WAIT_INTERVAL)
+
+        response = None
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            if response is not None and isFinal(response):
+                replayCache.put(key, response.content)
+            else:
+                replayCache.release(key)
+        return response
+    return wrapper
@@ -1,11 +1,15 @@
 import logging
 from django.db import models
-from django.db.models import Q
+from django.db.models import Count
 from django.db.models.aggregates import Sum
 from user.models import User
-from course.models import Course
+from course.models import Course, joinMask
 from elect_system.settings import ELE_TYPE
 import django.contrib.auth.models
+
+# Elections whose willing points are counted in User.curWp
+WP_STATUS = (ELE_TYPE.ELECTED, ELE_TYPE.PENDING, ELE_TYPE.NEW_ELECTED)
+
 '''
 election类内容介绍
 属性：
@@ -14,50 +18,122 @@ election类内容介绍
     willingpoint：本次选课的意愿点
     credit：本次选课的学分
     status：选课的情况，分为None、Elected以及Pending
+    选课记录的增删改都需要通过Course.bumpElectionCounters同步维护课程上的计数器，
+    意愿点的变化同步维护User.curWp
 '''
 
+
 class Election(models.Model):
     stu = models.ForeignKey(User, on_delete=models.PROTECT, null=False)
     crs = models.ForeignKey(Course, on_delete=models.PROTECT, null=False)
     willingpoint = models.IntegerField(default=0)
     credit = models.IntegerField(null=True)
     status = models.IntegerField(default=0)
-    #获取学生的选课情况
+    #获取学生的选课情况，课程和学生在同一次查询中读出
     def getCourseOfStudent(stuId: str) -> list:
-        crSet = Election.objects.filter(stu__username=stuId)
+        crSet = Election.objects.filter(stu__username=stuId).select_related('crs', 'stu')
         return list(crSet.all())
     #计算该学生当前选课已经使用的意愿点数
     def getWpCnt(stuId: str) -> int:
-        q0 = Q()
-        q0.connector = 'OR'
-        q0.children.append(('status', ELE_TYPE.ELECTED))
-        q0.children.append(('status', ELE_TYPE.PENDING))
-        crsSet = Election.objects.filter(stu__username=stuId)
-        crsSet = crsSet.filter(q0)
+        crsSet = Election.objects.filter(stu__username=stuId, status__in=WP_STATUS)
         total = crsSet.all().aggregate(total=Sum('willingpoint'))
         tot = total.get('total')
         if tot is None:
             tot = 0
         return tot
+    #一次查询获得该学生所有已选/待抽签课程时间位图的并集
+    def getSlotMaskOfStudent(stuId: str) -> int:
+        mask = 0
+        for lo, hi in Election.objects.filter(stu__username=stuId).values_list(
+                'crs__slot_mask_lo', 'crs__slot_mask_hi'):
+            mask |= joinMask(lo, hi)
+        return mask
+    # 校验选课操作所需的数据，返回(courses, elections)
+    #   courses：crsIds中存在的课程以及该学生选过的课程，{crsId: (credit, 时间位图)}
+    #   elections：该学生的全部选课，{crsId: (status, willingpoint)}
+    # 该学生的选课（按stu_id索引联表读出课程）和其余课程（按主键）分两次查询，
+    # crsIds都已选过时只需要第一次查询
+    def getElectSnapshot(stuPk: int, crsIds: list):
+        courses, elections = {}, {}
+        for courseId, status, wp, credit, lo, hi in Election.objects.filter(stu_id=stuPk).values_list(
+                'crs_id', 'status', 'willingpoint', 'crs__credit', 'crs__slot_mask_lo', 'crs__slot_mask_hi'):
+            courses[courseId] = (credit, joinMask(lo, hi))
+            elections[courseId] = (status, wp)
+        missing = [courseId for courseId in crsIds if courseId not in courses]
+        if missing:
+            for courseId, credit, lo, hi in Course.objects.filter(course_id__in=missing).values_list(
+                    'course_id', 'credit', 'slot_mask_lo', 'slot_mask_hi'):
+                courses[courseId] = (credit, joinMask(lo, hi))
+        return courses, elections
     #获取选择了某一课程的全部学生的信息
     def getStudentOfCourse(crsId: str) -> list:
         stuSet = Election.objects.filter(crs=crsId)
         return list(stuSet.all())
 
-    # 获取对于某一课程而言，当前已经选上课程的人数以及预计进行选课的人数
+    # 获取对于某一课程而言，当前已经选上课程的人数以及预计进行选课的人数（读取课程上的计数器）
     def getCourseElecionNum(crsId: str):
-        crSet = Election.objects.filter(crs=crsId)
-        elected = crSet.filter(status=ELE_TYPE.ELECTED).count()
-        pending = crSet.filter(status=ELE_TYPE.PENDING).count()
-        return elected, pending
+        nums = Course.objects.filter(course_id=crsId).values_list(
+            'elect_num', 'elect_newround_num').first()
+        if nums is None:
+            return 0, 0
+        return nums
+
+    # 一次分组聚合统计各课程实际的已选上/待抽签人数，{crsId: (elected, pending)}
+    def countByCourse() -> dict:
+        counts = {}
+        for crsId, status, num in Election.objects.values_list('crs_id', 'status').annotate(
+                num=Count('id')).order_by():
+            elected, pending = counts.get(crsId, (0, 0))
+            if status in (ELE_TYPE.ELECTED, ELE_TYPE.NEW_ELECTED):
+                elected += num
+            elif status == ELE_TYPE.PENDING:
+                pending += num
+            counts[crsId] = (elected, pending)
+        return counts
+
+    # 检查课程计数器与选课记录是否一致，fix为True时修正，返回[(crsId, 计数器, 实际值)]
+    def reconcileCourseCounters(fix: bool = False) -> list:
+        counts = Election.countByCourse()
+        drift, stale = [], []
+        for c in Course.objects.only('course_id', 'elect_num', 'elect_newround_num').iterator():
+            actual = counts.get(c.course_id, (0, 0))
+            if (c.elect_num, c.elect_newround_num) != actual:
+                drift.append((c.course_id, (c.elect_num, c.elect_newround_num), actual))
+                c.elect_num, c.elect_newround_num = actual
+                stale.append(c)
+        if fix:
+            Course.objects.bulk_update(stale, ['elect_num', 'elect_newround_num'], batch_size=1000)
+        return drift
+
+    # 检查学生的已用意愿点curWp与选课记录是否一致，fix为True时修正，返回[(uid, curWp, 实际值)]
+    def reconcileStudentWp(fix: bool = False) -> list:
+        actual = dict(Election.objects.filter(status__in=WP_STATUS).values_list('stu_id').annotate(
+            total=Sum('willingpoint')).order_by())
+        drift, stale = [], []
+        for u in User.objects.only('username', 'curWp').iterator():
+            wp = actual.get(u.pk, 0)
+            if u.curWp != wp:
+                drift.append((u.username, u.curWp, wp))
+                u.curWp = wp
+                stale.append(u)
+        if fix:
+            User.objects.bulk_update(stale, ['curWp'], batch_size=1000)
+        return drift
+
     #  检测函数，用于判断是否进行了重复选课
     def getStuElectionNum(stuId: str, crsId: str):
-        elSet = Election.objects.filter(stu__username=stuId, crs=crsId)
-        if elSet.count() == 1:
-            return elSet.get().status, elSet.get().willingpoint
-        elif elSet.count() > 1:
+        els = list(Election.objects.filter(stu__username=stuId, crs=crsId).values_list(
+            'status', 'willingpoint')[:2])
+        if len(els) == 1:
+            return els[0]
+        elif len(els) > 1:
             logging.error(
                 'Duplicate election: stuId={}, crsId={}'.format(stuId, crsId))
             return 0, 0
         else:
             return 0, 0
+
+    # 一次查询获得该学生的全部选课状态和意愿点，{crsId: (status, willingpoint)}
+    def getStuElections(stuId: str) -> dict:
+        return {crsId: (status, wp) for crsId, status, wp in Election.objects.filter(
+            stu__username=stuId).values_list('crs_id', 'status', 'willingpoint')}
@@ -1,11 +1,27 @@
 from django.test import TestCase
 from .models import *
-from user.models import User
+from user.models import User, stuLock
+from course.cache import catalogueCache
+from .idempotency import replayCache, idempotent
+from django.test import RequestFactory
+from django.http import JsonResponse
+from types import SimpleNamespace
 import json
-from elect_system.settings import ERR_TYPE, ELE_TYPE
+from elect_system.settings import ERR_TYPE, ELE_TYPE, ADMISSION
+from elect_system.admission import AdmissionController, admission
+import threading
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import time
+import asyncio
 
 #election类的测试类
 class ElectionTests(TestCase):
+    def setUp(self):
+        # 目录缓存和重放缓存在进程内，不随测试数据库回滚
+        catalogueCache.reset()
+        replayCache.reset()
+
     def test_elect(self):
         # 创建一个教务用户用于测试
         u = User.objects.create_user('jyeecs', password='123456')
@@ -189,6 +205,12 @@ class ElectionTests(TestCase):
             print("Error msg: " + str(resp.get('msg')))
         self.assertEqual(resp.get('success'), True)
 
+        # 只查询与已选课程不冲突的课程
+        respData = self.client.get('/course/courses?free=1')
+        resp = respData.json()
+        self.assertEqual(len(resp.get('course_list')), 1)
+        self.assertEqual(resp.get('course_list')[0].get('course_id'), '431543')
+
         # 时间冲突选课
         respData = self.client.post(
             '/election/elect', json.dumps({
@@ -221,6 +243,7 @@ class ElectionTests(TestCase):
             print("Error msg: " + str(resp.get('msg')))
         self.assertEqual(resp.get('success'), True)
         self.assertEqual(Election.getWpCnt('1600013239'), 99)
+        self.assertEqual(User.objects.get(username='1600013239').curWp, 99)
 
         # 取消选课操作
         respData = self.client.post(
@@ -239,6 +262,13 @@ class ElectionTests(TestCase):
             print("Error msg: " + str(resp.get('msg')))
         self.assertEqual(type(resp.get('data')), list)
         self.assertEqual(len(resp.get('data')), 2)
+        self.assertEqual(resp.get('curCredit'), 7)
+
+        # 课程信息已在目录缓存中，课表只需要会话、用户和选课三次查询
+        with CaptureQueriesContext(connection) as queries:
+            respData = self.client.get('/election/schedule')
+        self.assertEqual(len(respData.json().get('data')), 2)
+        self.assertEqual(len(queries), 3)
 
         # Stu修改选课的意愿点
         respData = self.client.post(
@@ -254,6 +284,11 @@ class ElectionTests(TestCase):
 
         # Stu 意愿点应当得到修改
         self.assertEqual(Election.getWpCnt('1600013239'), 1)
+        self.assertEqual(User.objects.get(username='1600013239').curWp, 1)
+        # 抽签选上的课程同样计入意愿点，与curWp一致
+        Election.objects.filter(stu__username='1600013239', crs='1233346').update(status=ELE_TYPE.NEW_ELECTED)
+        self.assertEqual(Election.getWpCnt('1600013239'), 1)
+        Election.objects.filter(stu__username='1600013239', crs='1233346').update(status=ELE_TYPE.PENDING)
         self.assertEqual(Election.getCourseElecionNum('1233346')[1], 1)
         crss = Election.getCourseOfStudent('1600013239')
         self.assertEqual(type(crss), list)
@@ -262,3 +297,191 @@ class ElectionTests(TestCase):
             '1600013239', '1233346')[0], ELE_TYPE.PENDING)
         self.assertEqual(Election.getStuElectionNum(
             '1600013239', '1233346')[1], 1)
+
+        # 不经过学生导入接口直接创建的学生也可以选课
+        stu = User.objects.create_user('1700012856', password='123456')
+        self.assertIs(stuLock.get('1700012856'), stuLock.get('1700012856'))
+        respData = self.client.post(
+            '/user/login', json.dumps({'uid': '1700012856', 'password': '123456'}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+        respData = self.client.post(
+            '/election/elect', json.dumps({'type': 0, 'course_id': '1233346', 'willingpoint': 2}),
+            content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+        respData = self.client.post(
+            '/election/elect', json.dumps({'type': 0, 'course_id': '1233346', 'willingpoint': 2}),
+            content_type="application/json")
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.ELE_DUP)
+        self.assertEqual(User.objects.get(username='1700012856').curCredit, 4)
+
+        # 添加课程的校验数据由两次索引查询获得，目标课程都已选过时只需要一次
+        with self.assertNumQueries(2):
+            courses, elections = Election.getElectSnapshot(stu.pk, ['431543', '404'])
+        self.assertEqual(courses['1233346'][0], 4)
+        self.assertEqual(courses['431543'][0], 3)
+        self.assertNotIn('404', courses)
+        self.assertEqual(elections, {'1233346': (ELE_TYPE.PENDING, 2)})
+        with self.assertNumQueries(1):
+            self.assertIn('1233346', Election.getElectSnapshot(stu.pk, ['1233346'])[0])
+
+        # 超出学分上限时不写入任何数据
+        User.objects.filter(pk=stu.pk).update(creditLimit=5)
+        respData = self.client.post(
+            '/election/elect', json.dumps({'type': 0, 'course_id': '431543', 'willingpoint': 0}),
+            content_type="application/json")
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.CRED_ERR)
+        self.assertEqual(User.objects.get(pk=stu.pk).curCredit, 4)
+        self.assertEqual(Election.getStuElectionNum('1700012856', '431543')[0], 0)
+
+        # 批量选课：后面的操作看到前面操作的结果，全部成功后一次写入
+        User.objects.filter(pk=stu.pk).update(creditLimit=25)
+        respData = self.client.post('/election/batch', json.dumps({'ops': [
+            {'type': 2, 'course_id': '1233346'},
+            {'type': 0, 'course_id': '431543', 'willingpoint': 5},
+            {'type': 0, 'course_id': '1233346', 'willingpoint': 3},
+            {'type': 1, 'course_id': '431543', 'willingpoint': 6},
+        ]}), content_type="application/json")
+        resp = respData.json()
+        self.assertEqual(resp.get('success'), True)
+        self.assertEqual(len(resp.get('results')), 4)
+        self.assertEqual(Election.getStuElections('1700012856'), {
+            '1233346': (ELE_TYPE.PENDING, 3), '431543': (ELE_TYPE.PENDING, 6)})
+        self.assertEqual(User.objects.get(pk=stu.pk).curCredit, 7)
+        self.assertEqual(Election.reconcileCourseCounters(), [])
+
+        # 任一操作失败时全部不写入
+        respData = self.client.post('/election/batch', json.dumps({'ops': [
+            {'type': 1, 'course_id': '431543', 'willingpoint': 1},
+            {'type': 0, 'course_id': '404'},
+        ]}), content_type="application/json")
+        resp = respData.json()
+        self.assertEqual(resp.get('msg'), ERR_TYPE.BATCH_FAIL)
+        self.assertEqual(resp.get('results')[0].get('success'), True)
+        self.assertEqual(resp.get('results')[1].get('msg'), ERR_TYPE.COURSE_404)
+        self.assertEqual(Election.getStuElections('1700012856')['431543'], (ELE_TYPE.PENDING, 6))
+        self.assertEqual(User.objects.get(pk=stu.pk).curWp, 9)
+
+        # 意愿点上限以学生的willingpointLimit为准
+        User.objects.filter(pk=stu.pk).update(willingpointLimit=10)
+        respData = self.client.post('/election/elect', json.dumps({
+            'type': 1, 'course_id': '431543', 'willingpoint': 8}), content_type="application/json")
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.WP_ERR)
+        respData = self.client.post('/election/elect', json.dumps({
+            'type': 1, 'course_id': '431543', 'willingpoint': 7}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+        self.assertEqual(User.objects.get(pk=stu.pk).curWp, 10)
+        User.objects.filter(pk=stu.pk).update(willingpointLimit=99)
+
+        # 带request_id的重试直接返回第一次的结果
+        for i in range(2):
+            respData = self.client.post('/election/elect', json.dumps({
+                'type': 2, 'course_id': '431543', 'request_id': 'quit-431543'}), content_type="application/json")
+            self.assertEqual(respData.json().get('success'), True)
+        self.assertEqual(replayCache.hits, 1)
+        self.assertNotIn('431543', Election.getStuElections('1700012856'))
+        self.assertEqual(User.objects.get(pk=stu.pk).curWp, 3)
+        self.assertEqual(Election.reconcileStudentWp(), [])
+        self.assertEqual(User.objects.get(pk=stu.pk).curCredit, 4)
+        # 不同的request_id正常处理
+        respData = self.client.post('/election/elect', json.dumps({
+            'type': 2, 'course_id': '431543', 'request_id': 'quit-431543-2'}), content_type="application/json")
+        self.assertEqual(respData.json().get('msg'), ERR_TYPE.ELE_404)
+        # 同一个request_id用于不同的接口时分别处理
+        respData = self.client.post('/election/batch', json.dumps({'request_id': 'quit-431543', 'ops': [
+            {'type': 0, 'course_id': '431543', 'willingpoint': 1}]}), content_type="application/json")
+        resp = respData.json()
+        self.assertEqual(resp.get('success'), True)
+        self.assertEqual(len(resp.get('results')), 1)
+        self.assertEqual(replayCache.hits, 1)
+        self.assertEqual(Election.getStuElections('1700012856')['431543'], (ELE_TYPE.PENDING, 1))
+
+    def test_replay_in_flight(self):
+        calls = []
+        started = threading.Event()
+        results = {'original': JsonResponse({'success': True}), 'phase': JsonResponse({'success': False, 'msg': ERR_TYPE.PHASE_ERR})}
+
+        @idempotent
+        def view(request):
+            name = json.loads(request.body.decode()).get('request_id')
+            calls.append(name)
+            started.set()
+            time.sleep(0.2)
+            return results[name]
+
+        def post(requestId):
+            request = RequestFactory().post('/election/elect', json.dumps({'request_id': requestId}),
+                                            content_type='application/json')
+            request.user = SimpleNamespace(is_authenticated=True, username='1700012856')
+            return view(request)
+
+        # 第一次请求处理期间到达的重试等待并重放第一次的响应，不再执行
+        got = []
+        original = threading.Thread(target=lambda: got.append(post('original')))
+        original.start()
+        started.wait()
+        retry = post('original')
+        original.join()
+        self.assertEqual(calls, ['original'])
+        self.assertEqual(json.loads(retry.content).get('success'), True)
+        self.assertEqual(retry.content, got[0].content)
+
+        # 暂时性的错误不保存，重试时重新处理
+        self.assertEqual(json.loads(post('phase').content).get('msg'), ERR_TYPE.PHASE_ERR)
+        post('phase')
+        self.assertEqual(calls, ['original', 'phase', 'phase'])
+
+    def test_admission(self):
+        ctl = AdmissionController(maxInFlight=1, maxQueue=1, maxWait=5, perUser=1)
+        self.assertTrue(ctl.acquire('a'))
+        # 同一用户的请求数达到上限
+        self.assertFalse(ctl.acquire('a'))
+
+        # 名额已满时排队，前一个请求结束后按顺序交给队首
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(ctl.acquire('b')))
+        waiter.start()
+        while ctl.stats()['queue_depth'] == 0:
+            time.sleep(0.001)
+        # 队列已满，立即拒绝
+        self.assertFalse(ctl.acquire('c'))
+        ctl.release('a')
+        waiter.join()
+        self.assertEqual(got, [True])
+        stats = ctl.stats()
+        self.assertEqual(stats['in_flight'], 1)
+        self.assertEqual(stats['rejected'], 2)
+        ctl.release('b')
+        self.assertEqual(ctl.stats()['in_flight'], 0)
+
+        # 异步请求在事件循环中排队，其他线程释放名额时被唤醒
+        self.assertTrue(ctl.acquire('a'))
+        releaser = threading.Timer(0.05, ctl.release, ['a'])
+        releaser.start()
+        self.assertTrue(asyncio.run(ctl.acquireAsync('b')))
+        releaser.join()
+        ctl.release('b')
+        self.assertEqual(ctl.stats()['in_flight'], 0)
+
+        # 排队超时
+        ctl = AdmissionController(maxInFlight=1, maxQueue=1, maxWait=0.01, perUser=1)
+        self.assertTrue(ctl.acquire('a'))
+        self.assertFalse(ctl.acquire('b'))
+        self.assertEqual(ctl.stats()['timeouts'], 1)
+
+        # 中间件对超出限制的用户返回429
+        User.objects.create_user('1700012856', password='123456')
+        respData = self.client.post(
+            '/user/login', json.dumps({'uid': '1700012856', 'password': '123456'}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+        for i in range(ADMISSION['PER_USER']):
+            self.assertTrue(admission.acquire('1700012856'))
+        try:
+            respData = self.client.get('/course/courses')
+            self.assertEqual(respData.status_code, 429)
+            self.assertEqual(respData['Retry-After'], str(ADMISSION['RETRY_AFTER']))
+            self.assertEqual(respData.json().get('msg'), ERR_TYPE.BUSY)
+        finally:
+            for i in range(ADMISSION['PER_USER']):
+                admission.release('1700012856')
+        respData = self.client.get('/course/courses')
+        self.assertEqual(respData.json().get('success'), True)
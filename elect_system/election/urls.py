@@ -6,5 +6,6 @@ from . import views
 urlpatterns = [
 	path('schedule', views.schedule),
 	re_path(r'schedule/(\w{0,})', views.schedule),
-	path('elect', views.elect)
+	path('elect', views.elect),
+	path('batch', views.batch),
 ]
@@ -2,22 +2,26 @@ from __future__ import with_statement  #: 2.5 only
 import typing
 from django.http.request import HttpRequest
 from django.http.response import JsonResponse
-from .models import Election
+from .models import Election, WP_STATUS
+from .batch import slotMaskOf, runBatch, BATCH_MAX_OPS
+from .idempotency import idempotent
 from user.models import User
 from user.models import stuLock
 from course.models import Course
 from phase.models import Phase
 from phase.views import isElectionOpen
-from course.views import get_time_json
+from course.views import get_course_json_list, COURSE_LIST_FIELDS
 from django.views.decorators.csrf import csrf_exempt
+from django.db import transaction
 from datetime import datetime
 from threading import Lock
+from contextlib import contextmanager
 import json
 import time
 import traceback
 from django.utils import timezone
 import logging
-from elect_system.settings import ELE_TYPE, ERR_TYPE
+from elect_system.settings import ELE_TYPE, ERR_TYPE, ELECT_LOCK_MODE
 import random
 import threading
 
@@ -41,64 +45,41 @@ def schedule(request: HttpRequest, uid: str = ''):
             })
 
         elList = Election.getCourseOfStudent(uid)
-        crsList = []
-        for el in elList:
-            electedNum, pendingNum = Election.getCourseElecionNum(el.crs.course_id)
-            crDict = {
-                "course_id": el.crs.course_id,
-                "name": el.crs.name,
-                "credit": el.crs.credit,
-                "main_class": el.crs.main_class,
-                "sub_class": el.crs.sub_class,
-                "times": get_time_json(el.crs),
-                "lecturer": el.crs.lecturer,
-                "pos": el.crs.pos,
-                "dept": el.crs.dept,
-                "election": {
-                    "status": el.status,
-                    "willingpoint": el.willingpoint,
-                    "elected_num": electedNum,
-                    "capacity": el.crs.capacity,
-                    "pending_num": pendingNum
-                }
-            }
-            crsList.append(crDict)
-
-        u = User.objects.get(username=request.user.username)
-
-        # Should not reach here
-        if u is None:
+        crsList = get_course_json_list([el.crs for el in elList],
+                                       {el.crs_id: (el.status, el.willingpoint) for el in elList},
+                                       COURSE_LIST_FIELDS)
+
+        # The student row comes with the elections, only a student without
+        # any election needs another query
+        if elList:
+            curCredit = elList[0].stu.curCredit
+        else:
+            curCredit = User.objects.filter(username=uid).values_list('curCredit', flat=True).first()
+        if curCredit is None:
             logging.error("User is None")
             return JsonResponse({'success': False, 'msg': ERR_TYPE.USER_404})
-        return JsonResponse({'success': True, 'curCredit': u.curCredit, 'data': crsList})
+        return JsonResponse({'success': True, 'curCredit': curCredit, 'data': crsList})
     else:
         return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
 
 
-def checkTime(stuId: str, crsId: str) -> bool:
-    crs = Course.getCourseObj(crsId)
-
-    times = crs.times.all()
-    tt = [[0 for i in range(10)] for j in range(8)]
-    for time in times:
-        d = time.day
-        p = time.period
-        tt[d][p] = 1
-
-    # All courses that are elected or pending
-    epList = Election.getCourseOfStudent(stuId)
-    for ce in epList:
-        c = Course.getCourseObj(ce.crs.course_id)
-        for time in c.times.all():
-            d = time.day
-            p = time.period
-            if tt[d][p]:
-                return False
-    return True
+# 在事务中锁住学生所在的行，同一学生的选课请求在所有进程间串行执行，
+# 事务提交或回滚时释放
+@contextmanager
+def studentRowLock(stuId: str):
+    with transaction.atomic():
+        list(User.objects.select_for_update().filter(username=stuId).values_list('pk', flat=True))
+        yield
 
 
-@csrf_exempt
-def elect(request: HttpRequest):
+def electLock(stuId: str):
+    if ELECT_LOCK_MODE == 'local':
+        return stuLock.get(stuId)
+    return studentRowLock(stuId)
+
+
+# elect和batch共同的检查，不通过时返回错误的JsonResponse
+def electPrecheck(request: HttpRequest):
     if request.method != 'POST':
         logging.warn(ERR_TYPE.INVALID_METHOD)
         return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
@@ -112,6 +93,26 @@ def elect(request: HttpRequest):
             'success': False,
             'msg': ERR_TYPE.NOT_ALLOWED,
         })
+    return None
+
+
+# 条件UPDATE失败后读出学生的额度，判断是意愿点还是学分超出了上限
+def chargeError(stuPk: int, credit: int, wp: int) -> str:
+    curCredit, creditLimit, curWp, wpLimit = User.objects.filter(pk=stuPk).values_list(
+        'curCredit', 'creditLimit', 'curWp', 'willingpointLimit').get()
+    if curWp + wp > wpLimit:
+        logging.error('Fail to add wp {}, cur wp is {}'.format(wp, curWp))
+        return ERR_TYPE.WP_ERR
+    logging.warn('creditLimit exceeded: {} + {} > {}'.format(curCredit, credit, creditLimit))
+    return ERR_TYPE.CRED_ERR
+
+
+@csrf_exempt
+@idempotent
+def elect(request: HttpRequest):
+    errResp = electPrecheck(request)
+    if errResp is not None:
+        return errResp
 
     try:
         reqData = json.loads(request.body.decode())
@@ -141,54 +142,41 @@ def elect(request: HttpRequest):
         return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
 
     # aquire lock
-    lck = stuLock.get(request.user.username)
-    if lck is None:
-        return JsonResponse({'success': False, 'msg': ERR_TYPE.UNKNOWN})
-
-    with lck:
+    with electLock(request.user.username):
         elSet = Election.objects.filter(
             stu__username=request.user.username, crs=courseId)
 
         # Election (add a new course to pending list)
+        # Duplicate and time checks run in memory on the snapshot, the credit
+        # and wp limits are enforced by the conditional update.
+        # An add costs 5 statements: two indexed snapshot reads, the charge
+        # UPDATE, the election INSERT and the counter UPDATE, plus the
+        # SELECT ... FOR UPDATE of studentRowLock in 'row' mode. The three
+        # writes touch three tables and cannot be merged
         if typeId == 0:
-            if elSet.count() != 0:
-                logging.error('Duplicate election: stu={}, crs={}, count={}'.format(
-                    request.user.username, courseId, elSet.count()))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.ELE_DUP})
-            if not Course.isLegal(courseId):
+            courses, elections = Election.getElectSnapshot(request.user.pk, [courseId])
+            if courseId not in courses:
                 logging.error(
                     'courseId not legal: courseId={}'.format(courseId))
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.COURSE_404})
+            if courseId in elections:
+                logging.error('Duplicate election: stu={}, crs={}'.format(
+                    request.user.username, courseId))
+                return JsonResponse({'success': False, 'msg': ERR_TYPE.ELE_DUP})
 
-            # Wp check
-            wpCnt = Election.getWpCnt(request.user.username)
-            if wpCnt + wp > 99:
-                logging.error(
-                    'Fail to add wp {}, cur wp is {}'.format(wp, wpCnt))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.WP_ERR})
-            if not checkTime(request.user.username, courseId):
+            # All courses that are elected or pending
+            credit, crsMask = courses[courseId]
+            if crsMask & slotMaskOf(elections, courses):
                 logging.error('Time conflict')
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.TIME_CONF})
 
-            # Credit check
-            u = User.objects.get(username=request.user.username)
-            c = Course.getCourseObj(crsId=courseId)
-
-            # Should not reach here
-            if u is None or c is None:
-                logging.error("User or course is None")
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-
-            if u.curCredit + c.credit > u.creditLimit:
-                logging.warn('creditLimit exceeded: {} + {} > {}'.format(
-                    u.curCredit, c.credit, u.creditLimit))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.CRED_ERR})
-
-            el = Election(willingpoint=wp, crs=c, credit=c.credit,
-                          stu=u, status=ELE_TYPE.PENDING)
-            u.curCredit += c.credit
-            u.save()
-            el.save()
+            with transaction.atomic():
+                # Credit and wp check
+                if not User.charge(request.user.pk, credit, wp):
+                    return JsonResponse({'success': False, 'msg': chargeError(request.user.pk, credit, wp)})
+                Election.objects.create(willingpoint=wp, crs_id=courseId, credit=credit,
+                                        stu_id=request.user.pk, status=ELE_TYPE.PENDING)
+                Course.bumpElectionCounters(courseId, pending=1)
             return JsonResponse({'success': True})
 
         # Edit wp
@@ -199,13 +187,13 @@ def elect(request: HttpRequest):
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.ELE_404})
             el = elSet.get()
 
-            wpCnt = Election.getWpCnt(request.user.username)
-            if wpCnt - el.willingpoint + wp > 99:
-                logging.error('Fail to add wp {}, cur wp is {}'.format(
-                    wp - el.willingpoint, wpCnt))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.WP_ERR})
-            el.willingpoint = wp
-            el.save()
+            with transaction.atomic():
+                if el.status in WP_STATUS and not User.addWp(request.user.pk, wp - el.willingpoint):
+                    logging.error('Fail to add wp {}, willingpointLimit exceeded'.format(
+                        wp - el.willingpoint))
+                    return JsonResponse({'success': False, 'msg': ERR_TYPE.WP_ERR})
+                el.willingpoint = wp
+                el.save(update_fields=['willingpoint'])
             return JsonResponse({'success': True})
 
         # Quit pending
@@ -215,16 +203,17 @@ def elect(request: HttpRequest):
                               'stu={}, crs={}'.format(request.user.username,
                                                       courseId))
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.ELE_404})
-            el = elSet.get()
+            el = elSet.select_related('crs').get()
             if el.status != ELE_TYPE.PENDING:
                 logging.error('This election is not pending, '
                               'stu={}, crs={}, op={}'.format(request.user.username,
                                                              courseId, typeId))
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.ELE_FAIL})
 
-            el.stu.curCredit -= el.crs.credit
-            el.stu.save()
-            el.delete()
+            with transaction.atomic():
+                User.refund(el.stu_id, el.crs.credit, el.willingpoint)
+                el.delete()
+                Course.bumpElectionCounters(courseId, pending=-1)
             return JsonResponse({'success': True})
 
         # Drop
@@ -233,16 +222,17 @@ def elect(request: HttpRequest):
                 logging.error('This election does not exists: stu={}, crs={}'.format(
                     request.user.username, courseId))
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.ELE_404})
-            el = elSet.get()
+            el = elSet.select_related('crs').get()
             if el.status != ELE_TYPE.ELECTED:
                 logging.error('This election is not elected, '
                               'stu={}, crs={}, op={}'.format(request.user.username,
                                                              courseId, typeId))
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.ELE_FAIL})
 
-            el.stu.curCredit -= el.crs.credit
-            el.stu.save()
-            el.delete()
+            with transaction.atomic():
+                User.refund(el.stu_id, el.crs.credit, el.willingpoint)
+                el.delete()
+                Course.bumpElectionCounters(courseId, elected=-1)
             return JsonResponse({'success': True})
 
         else:
@@ -250,6 +240,36 @@ def elect(request: HttpRequest):
             return JsonResponse({"success": False, 'msg': ERR_TYPE.PARAM_ERR})
 
 
+# 批量选课，ops为elect接口参数的列表，全部成功时才写入
+@csrf_exempt
+@idempotent
+def batch(request: HttpRequest):
+    errResp = electPrecheck(request)
+    if errResp is not None:
+        return errResp
+
+    try:
+        reqData = json.loads(request.body.decode())
+    except:
+        traceback.print_exc()
+        logging.error('Json format error, req.body={}'.format(
+            request.body.decode()))
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.JSON_ERR})
+    ops = reqData.get('ops')
+    if type(ops) is not list or len(ops) == 0:
+        logging.warn('ops param err, req={}'.format(reqData))
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
+    if len(ops) > BATCH_MAX_OPS:
+        logging.warn('Too many ops in one batch: {}'.format(len(ops)))
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.BATCH_LIMIT})
+
+    with electLock(request.user.username):
+        ok, results = runBatch(request.user.pk, ops)
+    if not ok:
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.BATCH_FAIL, 'results': results})
+    return JsonResponse({'success': True, 'results': results})
+
+
 @DeprecationWarning
 def random_select(wpList, num):
     base_wp = 10
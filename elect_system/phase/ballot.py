@@ -0,0 +1,151 @@
+import time
+import logging
+from datetime import datetime
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from election.models import Election
+from user.models import User, Message
+from course.models import Course
+from elect_system.settings import ELE_TYPE, BALLOT_WORKERS
+from .lottery import runLottery, counterDeltas
+from user.notify import notifyHub
+
+'''
+基于集合操作的抽签引擎
+
+    loadBallotPool：一次流式查询读出所有已选上/待抽签的选课记录，按课程分组
+    applyBallotResult：在同一个事务中批量写回抽签结果、学分和意愿点的退还以及课程计数器
+    runBallot：完整的一轮抽签，workers > 1 时各课程分片在进程池中并行排序
+    pushBallotMessages：按学生汇总抽签结果，批量生成消息并清理抽签状态
+'''
+
+# Max size of the IN (...) list in one bulk statement
+BALLOT_CHUNK = 2000
+BALLOT_MSG_TITLE = '抽签结果'
+
+
+def chunked(seq: list, size: int = BALLOT_CHUNK):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def loadBallotPool() -> dict:
+    rows = Election.objects.filter(
+        status__in=[ELE_TYPE.ELECTED, ELE_TYPE.PENDING]).order_by('id').values_list(
+        'id', 'stu_id', 'crs_id', 'willingpoint', 'status', 'crs__credit', 'crs__capacity')
+    capacity, elected, pending = {}, {}, {}
+    for elId, stuId, crsId, wp, status, credit, cap in rows.iterator(chunk_size=BALLOT_CHUNK):
+        capacity[crsId] = cap
+        if status == ELE_TYPE.ELECTED:
+            elected[crsId] = elected.get(crsId, 0) + 1
+        else:
+            pending.setdefault(crsId, []).append((elId, stuId, wp, credit))
+    # Courses without pending elections need no ballot
+    return {crsId: (capacity[crsId] - elected.get(crsId, 0), pendingList)
+            for crsId, pendingList in pending.items()}
+
+
+def applyBallotResult(okIds: list, failIds: list, refunds: dict, deltas: dict):
+    # Students sharing the same refund amounts (and courses sharing the same
+    # counter deltas) are updated in one statement
+    stuByRefund = {}
+    for stuId, refund in refunds.items():
+        stuByRefund.setdefault(refund, []).append(stuId)
+    crsByDelta = {}
+    for crsId, delta in deltas.items():
+        crsByDelta.setdefault(delta, []).append(crsId)
+
+    with transaction.atomic():
+        for ids in chunked(okIds):
+            Election.objects.filter(id__in=ids).update(status=ELE_TYPE.NEW_ELECTED)
+        for ids in chunked(failIds):
+            Election.objects.filter(id__in=ids).update(status=ELE_TYPE.NEW_FAILED)
+        for (credit, wp), stuIds in stuByRefund.items():
+            for ids in chunked(stuIds):
+                User.objects.filter(pk__in=ids).update(
+                    curCredit=F('curCredit') - credit, curWp=F('curWp') - wp)
+        for (electedDelta, pendingDelta), crsIds in crsByDelta.items():
+            for ids in chunked(crsIds):
+                Course.objects.filter(course_id__in=ids).update(
+                    elect_num=F('elect_num') + electedDelta,
+                    elect_newround_num=F('elect_newround_num') + pendingDelta)
+
+
+def runBallot(workers: int = None) -> dict:
+    if workers is None:
+        workers = BALLOT_WORKERS
+    startTime = time.time()
+    pool = loadBallotPool()
+    loadTime = time.time()
+    okIds, failIds, refunds = runLottery(pool, workers)
+    rankTime = time.time()
+    applyBallotResult(okIds, failIds, refunds, counterDeltas(pool))
+    endTime = time.time()
+
+    stats = {
+        'courses': len(pool),
+        'workers': workers,
+        'elected': len(okIds),
+        'failed': len(failIds),
+        'load_time': loadTime - startTime,
+        'rank_time': rankTime - loadTime,
+        'apply_time': endTime - rankTime,
+    }
+    logging.info('Ballot finished: courses={courses}, workers={workers}, elected={elected}, failed={failed}, '
+                 'load={load_time:.3f}s, rank={rank_time:.3f}s, apply={apply_time:.3f}s'.format(**stats))
+    return stats
+
+
+def ballotMessageContent(okNames: list, failNames: list) -> str:
+    return '抽签结束，您成功选中的课程：' + '、'.join(okNames) + \
+        '，未选中的课程：' + '、'.join(failNames) + '。'
+
+
+def pushBallotMessages(uid: str = None) -> int:
+    rows = Election.objects.filter(
+        status__in=[ELE_TYPE.NEW_ELECTED, ELE_TYPE.NEW_FAILED])
+    if uid is not None:
+        rows = rows.filter(stu__username=uid)
+
+    # stuId -> (okNames, failNames)
+    results = {}
+    for stuId, status, crsName in rows.order_by('id').values_list(
+            'stu_id', 'status', 'crs__name').iterator(chunk_size=BALLOT_CHUNK):
+        okNames, failNames = results.setdefault(stuId, ([], []))
+        if status == ELE_TYPE.NEW_ELECTED:
+            okNames.append(crsName or '')
+        else:
+            failNames.append(crsName or '')
+    if not results:
+        return 0
+
+    stuIds = list(results)
+    curTime = timezone.make_aware(datetime.now())
+    msgs = [Message(title=BALLOT_MSG_TITLE, genTime=curTime, hasRead=False,
+                    content=ballotMessageContent(*results[stuId])) for stuId in stuIds]
+
+    with transaction.atomic():
+        Message.objects.bulk_create(msgs, batch_size=BALLOT_CHUNK)
+        # MySQL does not return the ids of bulk inserted rows, but the ids
+        # of one insert are ascending in row order
+        msgIds = [msg.id for msg in msgs]
+        if None in msgIds:
+            msgIds = list(Message.objects.filter(
+                title=BALLOT_MSG_TITLE, genTime=curTime).order_by('id').values_list('id', flat=True))
+            if len(msgIds) != len(stuIds):
+                raise RuntimeError('Ballot message count mismatch: {} != {}'.format(
+                    len(msgIds), len(stuIds)))
+
+        UserMessage = User.messages.through
+        UserMessage.objects.bulk_create(
+            [UserMessage(user_id=stuId, message_id=msgId) for stuId, msgId in zip(stuIds, msgIds)],
+            batch_size=BALLOT_CHUNK)
+        for ids in chunked(stuIds):
+            User.objects.filter(pk__in=ids).update(unreadMsgNum=F('unreadMsgNum') + 1)
+        rows.filter(status=ELE_TYPE.NEW_ELECTED).update(status=ELE_TYPE.ELECTED)
+        rows.filter(status=ELE_TYPE.NEW_FAILED).delete()
+
+    notifyHub.publish()
+    logging.info('Ballot messages pushed to {} students'.format(len(stuIds)))
+    return len(stuIds)
@@ -0,0 +1,81 @@
+from elect_system.pools import getPool
+
+'''
+抽签引擎的纯内存部分
+
+这里的函数只处理普通的tuple/list/dict，不依赖Django和数据库，
+方便在子进程或模拟环境中直接运行。
+子进程以spawn方式启动：抽签在web进程的调度线程中运行，fork会把其他线程持有的锁和
+打开的数据库连接复制到子进程中。进程池在第一次抽签时创建，之后复用（见elect_system/pools.py）。
+
+pool: {crsId: (capacityLeft, pendingList)}
+    capacityLeft：课程剩余的名额（capacity - 已选上人数，可能为负数）
+    pendingList：[(elId, stuId, willingpoint, credit), ...]
+抽签结果为(okIds, failIds, refunds)，refunds: {stuId: (退还的学分, 退还的意愿点)}
+'''
+
+# Shards per worker, more shards smooth out uneven course sizes
+SHARDS_PER_WORKER = 4
+
+
+def rankCourse(capacityLeft: int, pendingList: list):
+    # Willing point is the only factor, ties are broken by election id
+    # (the order the elections were made in)
+    ranked = sorted(pendingList, key=lambda el: (-el[2], el[0]))
+    okIds, failIds, refunds = [], [], {}
+    for i, (elId, stuId, wp, credit) in enumerate(ranked):
+        # Succeeded
+        if i < capacityLeft:
+            okIds.append(elId)
+        # Failed, credit and willing points go back to the student
+        else:
+            failIds.append(elId)
+            refundCredit, refundWp = refunds.get(stuId, (0, 0))
+            refunds[stuId] = (refundCredit + credit, refundWp + wp)
+    return okIds, failIds, refunds
+
+
+def rankShard(shard: dict) -> dict:
+    return {crsId: rankCourse(capacityLeft, pendingList)
+            for crsId, (capacityLeft, pendingList) in shard.items()}
+
+
+def shardPool(pool: dict, shardNum: int) -> list:
+    # Greedy balancing: the biggest course goes to the lightest shard
+    shards = [{} for i in range(shardNum)]
+    loads = [0] * shardNum
+    for crsId in sorted(pool, key=lambda c: len(pool[c][1]), reverse=True):
+        idx = loads.index(min(loads))
+        shards[idx][crsId] = pool[crsId]
+        loads[idx] += len(pool[crsId][1])
+    return [s for s in shards if s]
+
+
+def mergeResults(results: dict):
+    # Merge in course order so that the output never depends on sharding
+    okIds, failIds, refunds = [], [], {}
+    for crsId in sorted(results):
+        crsOk, crsFail, crsRefunds = results[crsId]
+        okIds += crsOk
+        failIds += crsFail
+        for stuId, (credit, wp) in crsRefunds.items():
+            refundCredit, refundWp = refunds.get(stuId, (0, 0))
+            refunds[stuId] = (refundCredit + credit, refundWp + wp)
+    return okIds, failIds, refunds
+
+
+def runLottery(pool: dict, workers: int = 1):
+    if workers <= 1 or len(pool) <= 1:
+        return mergeResults(rankShard(pool))
+
+    results = {}
+    shards = shardPool(pool, workers * SHARDS_PER_WORKER)
+    for shardResult in getPool(workers).map(rankShard, shards):
+        results.update(shardResult)
+    return mergeResults(results)
+
+
+# 抽签后各课程计数器的变化量，{crsId: (electedDelta, pendingDelta)}
+def counterDeltas(pool: dict) -> dict:
+    return {crsId: (min(max(capacityLeft, 0), len(pendingList)), -len(pendingList))
+            for crsId, (capacityLeft, pendingList) in pool.items()}
@@ -0,0 +1,61 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from elect_system.settings import BALLOT_WORKERS
+from phase.ballot import loadBallotPool
+from phase.lottery import runLottery
+from phase.simulation import syntheticPool, summarize
+
+
+# 抽签的预演：只在内存中运行抽签引擎，不修改任何数据
+#   默认读取当前数据库中已选上/待抽签的选课记录；指定--students时生成模拟数据
+class Command(BaseCommand):
+    help = 'Dry-run the ballot in memory on the current elections or on a synthetic workload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=0,
+                            help='Generate a synthetic workload with this many students')
+        parser.add_argument('--courses', type=int, default=500,
+                            help='Number of courses of the synthetic workload')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed of the synthetic workload')
+        parser.add_argument('--workers', type=int, default=BALLOT_WORKERS,
+                            help='Worker processes used to rank the courses')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the report as json')
+
+    def handle(self, *args, **options):
+        startTime = time.time()
+        if options['students'] > 0:
+            pool = syntheticPool(options['students'], options['courses'], options['seed'])
+            source = 'synthetic'
+        else:
+            pool = loadBallotPool()
+            source = 'snapshot'
+        loadTime = time.time()
+        okIds, failIds, refunds = runLottery(pool, options['workers'])
+        rankTime = time.time()
+
+        report = summarize(pool, okIds, failIds)
+        report.update({
+            'source': source,
+            'workers': options['workers'],
+            'load_time': loadTime - startTime,
+            'rank_time': rankTime - loadTime,
+        })
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write('Ballot dry run ({source}, workers={workers}): load {load_time:.3f}s, '
+                          'rank {rank_time:.3f}s'.format(**report))
+        self.stdout.write('{courses} courses, {students} students, {elections} pending elections'.format(**report))
+        self.stdout.write('elected {elected}, failed {failed}, acceptance {acceptance:.1%}'.format(**report))
+        fill = report['course_fill']
+        self.stdout.write('course fill: p50 {:.1%}, p90 {:.1%}, histogram {}'.format(
+            fill['p50'], fill['p90'], fill['histogram']))
+        demand = report['course_demand']
+        self.stdout.write('course demand (pending / capacity left): p50 {:.2f}, p90 {:.2f}, max {:.2f}'.format(
+            demand['p50'], demand['p90'], demand['max']))
+        self.stdout.write('students elected in none / some / all of their courses: {none} / {some} / {all}'.format(
+            **report['student_outcome']))
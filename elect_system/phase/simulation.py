@@ -0,0 +1,112 @@
+import random
+import itertools
+
+'''
+抽签的模拟
+
+与lottery.py一样只处理普通的数据结构，不依赖Django和数据库：
+    syntheticPool：按给定的学生数、课程数生成一个可复现的抽签池
+    summarize：根据抽签池和抽签结果统计课程的录取情况以及学生的中签情况
+'''
+
+# Fill ratio buckets of a course (elected / capacity left), full courses are counted apart
+FILL_BUCKETS = [0.25, 0.5, 0.75]
+FILL_LABELS = ['<=25%', '<=50%', '<=75%', '<100%', 'full']
+
+
+# 生成抽签池，课程热度服从长尾分布，每个学生把99点意愿点随机分配给选择的课程
+def syntheticPool(students: int, courses: int, seed: int = 0,
+                  minPick: int = 3, maxPick: int = 8, wpLimit: int = 99) -> dict:
+    rnd = random.Random(seed)
+    crsIds = [str(100000 + c) for c in range(courses)]
+    # Zipf-like popularity, a few courses attract most of the students
+    weights = [1.0 / (rank + 1) for rank in range(courses)]
+    rnd.shuffle(weights)
+    cumWeights = list(itertools.accumulate(weights))
+    credits = [rnd.randint(1, 5) for c in range(courses)]
+    capacities = [rnd.choice([30, 60, 100, 150, 200]) for c in range(courses)]
+
+    pending = {crsId: [] for crsId in crsIds}
+    elId = 0
+    for stuId in range(1, students + 1):
+        picks = set()
+        target = min(rnd.randint(minPick, maxPick), courses)
+        while len(picks) < target:
+            picks.add(rnd.choices(range(courses), cum_weights=cumWeights)[0])
+        # Most students put their points on one or two favourite courses
+        shares = [rnd.expovariate(1.0) ** 2 for c in picks]
+        total = sum(shares)
+        for c, share in zip(sorted(picks), shares):
+            elId += 1
+            wp = int(wpLimit * share / total)
+            pending[crsIds[c]].append((elId, stuId, wp, credits[c]))
+
+    return {crsId: (capacities[c], pending[crsId])
+            for c, crsId in enumerate(crsIds) if pending[crsId]}
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+# 统计抽签结果，返回可以直接输出为json的dict
+def summarize(pool: dict, okIds: list, failIds: list) -> dict:
+    okSet = set(okIds)
+    applied, elected = {}, {}
+    fills, demands = [], []
+    fillHist = [0] * len(FILL_LABELS)
+    for crsId, (capacityLeft, pendingList) in pool.items():
+        okNum = 0
+        for elId, stuId, wp, credit in pendingList:
+            applied[stuId] = applied.get(stuId, 0) + 1
+            if elId in okSet:
+                okNum += 1
+                elected[stuId] = elected.get(stuId, 0) + 1
+        if capacityLeft > 0:
+            fill = okNum / capacityLeft
+            demands.append(len(pendingList) / capacityLeft)
+        else:
+            fill = 1.0
+        fills.append(fill)
+        if fill >= 1.0:
+            bucket = len(FILL_LABELS) - 1
+        else:
+            bucket = 0
+            while bucket < len(FILL_BUCKETS) and fill > FILL_BUCKETS[bucket]:
+                bucket += 1
+        fillHist[bucket] += 1
+
+    # Share of each student's applications that succeeded
+    stuHist = {'none': 0, 'some': 0, 'all': 0}
+    for stuId, num in applied.items():
+        okNum = elected.get(stuId, 0)
+        if okNum == 0:
+            stuHist['none'] += 1
+        elif okNum == num:
+            stuHist['all'] += 1
+        else:
+            stuHist['some'] += 1
+
+    total = len(okIds) + len(failIds)
+    return {
+        'courses': len(pool),
+        'students': len(applied),
+        'elections': total,
+        'elected': len(okIds),
+        'failed': len(failIds),
+        'acceptance': len(okIds) / total if total else 0.0,
+        'course_fill': {
+            'p50': percentile(fills, 0.5),
+            'p90': percentile(fills, 0.9),
+            'histogram': dict(zip(FILL_LABELS, fillHist)),
+        },
+        'course_demand': {
+            'p50': percentile(demands, 0.5),
+            'p90': percentile(demands, 0.9),
+            'max': max(demands) if demands else 0,
+        },
+        'student_outcome': stuHist,
+    }
@@ -1,8 +1,16 @@
 from django.test import TestCase
 from user.models import User
 from phase.models import Phase
-from elect_system.settings import ERR_TYPE
+from course.models import Course
+from election.models import Election
+from elect_system.settings import ERR_TYPE, ELE_TYPE
+from .views import fairBallot
+from .lottery import runLottery
+from .simulation import syntheticPool, summarize
+from django.core.management import call_command
+from io import StringIO
 import json
+import random
 from django.utils import timezone
 from datetime import datetime
 
@@ -133,3 +141,103 @@ class PhaseTests(TestCase):
         respData = self.client.get('/phase/phases')
         resp = respData.json()
         self.assertEqual(len(resp.get('data')), 0)
+
+
+class BallotTests(TestCase):
+    def test_fair_ballot(self):
+        # 两门课程，c0只剩一个名额
+        c0 = Course.objects.create(course_id='1233346', name='软件工程', credit=4,
+                                   sub_class='A', lecturer='孙艳春', pos='理教201', dept=48, capacity=2)
+        c1 = Course.objects.create(course_id='431543', name='天体物理专题', credit=3,
+                                   sub_class='A', lecturer='李立新', pos='待定', dept=4, capacity=40)
+        stus = []
+        for uid in ['1600013239', '1700012855', '1700012856']:
+            u = User.objects.create_user(uid, password='123456')
+            stus.append(u)
+
+        # c0已经有一个学生选上
+        Election.objects.create(stu=stus[2], crs=c0, willingpoint=0,
+                                credit=4, status=ELE_TYPE.ELECTED)
+        # 意愿点相同时先选课的学生优先
+        Election.objects.create(stu=stus[0], crs=c0, willingpoint=10,
+                                credit=4, status=ELE_TYPE.PENDING)
+        Election.objects.create(stu=stus[1], crs=c0, willingpoint=10,
+                                credit=4, status=ELE_TYPE.PENDING)
+        Election.objects.create(stu=stus[1], crs=c1, willingpoint=0,
+                                credit=3, status=ELE_TYPE.PENDING)
+        User.objects.filter(pk=stus[0].pk).update(curCredit=4)
+        User.objects.filter(pk=stus[1].pk).update(curCredit=7)
+        User.objects.filter(pk=stus[2].pk).update(curCredit=4)
+        self.assertEqual(len(Election.reconcileStudentWp(fix=True)), 2)
+
+        # 直接写入的选课记录需要先修正课程计数器
+        self.assertEqual(len(Election.reconcileCourseCounters(fix=True)), 2)
+        self.assertEqual(Election.getCourseElecionNum('1233346'), (1, 2))
+
+        fairBallot()
+
+        self.assertEqual(Election.getStuElectionNum('1600013239', '1233346')[0], ELE_TYPE.ELECTED)
+        self.assertEqual(Election.getStuElectionNum('1700012855', '1233346')[0], 0)
+        self.assertEqual(Election.getStuElectionNum('1700012855', '431543')[0], ELE_TYPE.ELECTED)
+        self.assertEqual(Election.getStuElectionNum('1700012856', '1233346')[0], ELE_TYPE.ELECTED)
+        self.assertEqual(User.objects.get(username='1600013239').curCredit, 4)
+        self.assertEqual(User.objects.get(username='1700012855').curCredit, 3)
+        self.assertEqual(User.objects.get(username='1700012856').curCredit, 4)
+        # 抽签失败的意愿点退还给学生
+        self.assertEqual(User.objects.get(username='1600013239').curWp, 10)
+        self.assertEqual(User.objects.get(username='1700012855').curWp, 0)
+        self.assertEqual(Election.reconcileStudentWp(), [])
+
+        self.assertEqual(Election.getCourseElecionNum('1233346'), (2, 0))
+        self.assertEqual(Election.getCourseElecionNum('431543'), (1, 0))
+        self.assertEqual(Election.reconcileCourseCounters(), [])
+
+        # 参与抽签的学生各收到一条抽签结果消息
+        self.assertEqual(User.objects.get(username='1600013239').messages.count(), 1)
+        self.assertEqual(User.objects.get(username='1700012855').messages.count(), 1)
+        self.assertEqual(User.objects.get(username='1700012856').messages.count(), 0)
+        self.assertEqual(User.objects.get(username='1700012855').unreadMsgNum, 1)
+        self.assertEqual(User.reconcileUnread(), [])
+        msg = User.objects.get(username='1700012855').messages.get()
+        self.assertEqual(msg.content, '抽签结束，您成功选中的课程：天体物理专题，未选中的课程：软件工程。')
+
+    def test_parallel_lottery(self):
+        # 并行抽签的结果必须与串行抽签完全一致
+        rnd = random.Random(2020)
+        pool = {}
+        elId = 0
+        for c in range(60):
+            pendingList = []
+            for i in range(rnd.randint(0, 80)):
+                elId += 1
+                pendingList.append((elId, rnd.randint(1, 300), rnd.randint(0, 99), rnd.randint(1, 5)))
+            pool[str(100000 + c)] = (rnd.randint(-5, 60), pendingList)
+
+        serial = runLottery(pool, 1)
+        parallel = runLottery(pool, 3)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len(serial[0]) + len(serial[1]), elId)
+
+    def test_simulation(self):
+        # 模拟数据可以复现
+        pool = syntheticPool(300, 20, seed=7)
+        self.assertEqual(pool, syntheticPool(300, 20, seed=7))
+        okIds, failIds, refunds = runLottery(pool)
+        report = summarize(pool, okIds, failIds)
+        self.assertEqual(report['students'], 300)
+        self.assertEqual(report['elected'] + report['failed'], report['elections'])
+        self.assertEqual(sum(report['course_fill']['histogram'].values()), report['courses'])
+        self.assertEqual(sum(report['student_outcome'].values()), 300)
+
+        # 预演当前的选课记录，不修改任何数据
+        c0 = Course.objects.create(course_id='1233346', name='软件工程', credit=4,
+                                   sub_class='A', lecturer='孙艳春', pos='理教201', dept=48, capacity=1)
+        for uid in ['1600013239', '1700012855']:
+            u = User.objects.create_user(uid, password='123456')
+            Election.objects.create(stu=u, crs=c0, willingpoint=10, credit=4, status=ELE_TYPE.PENDING)
+        out = StringIO()
+        call_command('simulate_ballot', '--json', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['source'], 'snapshot')
+        self.assertEqual((report['elected'], report['failed']), (1, 1))
+        self.assertEqual(Election.objects.filter(status=ELE_TYPE.PENDING).count(), 2)
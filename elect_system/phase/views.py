@@ -4,7 +4,9 @@ import logging
 from threading import Lock
 from django.http.request import HttpRequest
 from django.http.response import JsonResponse
-from .models import Phase, electionOpen, sch
+from .models import Phase, sch
+from . import models as phaseModels
+from user.notify import notifyHub
 from django.views.decorators.csrf import csrf_exempt
 from datetime import datetime
 from django.utils import timezone
@@ -12,6 +14,7 @@ from elect_system.settings import ERR_TYPE, ELE_TYPE
 from election.models import Election
 from user.models import User, Message
 from course.models import Course
+from .ballot import runBallot, pushBallotMessages
 from django_apscheduler.jobstores import DjangoJobStore, register_events, register_job
 
 sch.add_jobstore(DjangoJobStore(), 'default')
@@ -20,7 +23,13 @@ sch.start()
 
 
 def isElectionOpen():
-    return electionOpen
+    return phaseModels.electionOpen
+
+
+# 开放或关闭选课，并通知等待中的长轮询
+def setElectionOpen(isOpen: bool):
+    phaseModels.electionOpen = isOpen
+    notifyHub.publish()
 
 
 @csrf_exempt
@@ -130,76 +139,14 @@ def phases_new(request: HttpRequest, phid: str = ''):
         return JsonResponse({'success': False, 'msg': 'Invalid method'})
 
 
-def fetchWp(el: Election):
-    return el.willingpoint
-
-
-def courseFairBallot(elList: list, fetchNum: int):
-    elList.sort(key=fetchWp, reverse=True)
-    for i, el in enumerate(elList):
-        # Succeeded
-        if (i < fetchNum):
-            el.status = ELE_TYPE.NEW_ELECTED
-            el.save()
-        # Failed
-        else:
-            el.stu.curCredit -= el.crs.credit
-            el.status = ELE_TYPE.NEW_FAILED
-            el.save()
-            el.stu.save()
-
-
-def pushMessage(uid: str):
-    msgStr = '抽签结束，您成功选中的课程：'
-    okSet = Election.objects.filter(stu__username=uid).filter(status=ELE_TYPE.NEW_ELECTED)
-    idx = 0
-    for el in okSet:
-        if idx > 0:
-            msgStr += '、'
-        msgStr += (el.crs.name)
-        el.status = ELE_TYPE.ELECTED
-        el.save()
-        idx += 1
-    
-    msgStr += '，未选中的课程：'
-    failSet = Election.objects.filter(stu__username=uid).filter(status=ELE_TYPE.NEW_FAILED)
-    idx = 0
-    for el in failSet:
-        if idx > 0:
-            msgStr += '、'
-        msgStr += (el.crs.name)
-        el.delete()
-        idx += 1
-    msgStr += '。'
-    
-    if okSet.exists() or failSet.exists():
-        uSet = User.objects.filter(username=uid)
-        u = uSet.get()
-        curTime = timezone.make_aware(datetime.now())
-        msg = Message.objects.create(title='抽签结果', genTime=curTime, content=msgStr, hasRead=False)
-        msg.save()
-        u.messages.add(msg)
-        u.save()
-
-
 # Ballot fairly: willing point is the only factor that determine ballot result
 def fairBallot():
-    electionOpen = False
-    for crs in Course.objects.all():
-        electedNum = Election.objects.filter(
-            crs=crs.course_id).filter(status=ELE_TYPE.ELECTED).count()
-        pendingSet = Election.objects.filter(
-            crs=crs.course_id).filter(status=ELE_TYPE.PENDING)
-        capacityLeft = crs.capacity - electedNum
-        logging.info('Balloting on course {}, cap={}, elected={}, pending={}'.format(crs.course_id,
-                                                                                     crs.capacity, electedNum, pendingSet.count()))
-        courseFairBallot(list(pendingSet), capacityLeft)
-    for stu in User.objects.all():
-        if stu.is_superuser:
-            logging.error('Why dean appear in User table? uid={}'.format(stu.username))
-        pushMessage(stu.username)
-
-    electionOpen = True
+    setElectionOpen(False)
+    try:
+        runBallot()
+        pushBallotMessages()
+    finally:
+        setElectionOpen(True)
 
 
 """
@@ -0,0 +1,159 @@
+import csv
+import io
+import json
+import logging
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction, IntegrityError
+import django.contrib.auth.models
+from elect_system.settings import ERR_TYPE, STU_IMPORT
+from elect_system.pools import getPool
+from .models import User
+
+'''
+学生的批量导入
+
+与逐个create_user相比：
+    所有行先在内存中校验，已存在的uid用一次查询找出
+    密码的PBKDF2哈希在进程池中并行计算（spawn方式启动，不复制web进程的线程、锁和数据库连接；
+    进程池在进程内复用，见elect_system/pools.py）
+    每CHUNK行在一个事务中插入：auth_user用bulk_create，
+    多表继承的子表（Django不支持bulk_create）用一条executemany
+返回(创建的学生数, 错误列表)，错误为{'row': 行号（从1开始）, 'uid': uid, 'msg': ERR_TYPE.X}，
+有错误的行不会导入，其余的行正常导入。
+'''
+
+AuthUser = django.contrib.auth.models.User
+
+FIELDS = ['uid', 'name', 'gender', 'dept', 'grade', 'password', 'credit_limit']
+
+
+# 读取json（{'students': [...]}或列表）或csv（表头为FIELDS）格式的学生列表
+def readRows(content: str, fmt: str = 'json') -> list:
+    if fmt == 'csv':
+        return list(csv.DictReader(io.StringIO(content)))
+    data = json.loads(content)
+    if isinstance(data, dict):
+        data = data.get('students')
+    if not isinstance(data, list):
+        raise ValueError('no students list')
+    return data
+
+
+def parseGender(gender) -> bool:
+    if isinstance(gender, str):
+        return gender.strip().lower() not in ('0', 'false', 'f', 'female')
+    return bool(gender)
+
+
+# 校验一行并转换为User的字段，格式错误时抛出ValueError
+def parseRow(stu) -> dict:
+    if not isinstance(stu, dict):
+        raise ValueError('row is not an object')
+    # Empty csv cells are treated as missing
+    stu = {k: v for k, v in stu.items() if v not in (None, '')}
+    uid = stu.get('uid')
+    passwd = stu.get('password')
+    if uid is None or passwd is None:
+        raise ValueError('missing uid or password')
+    return {
+        'username': str(uid),
+        'password': str(passwd),
+        'name': stu.get('name', ''),
+        'gender': parseGender(stu['gender']) if 'gender' in stu else True,
+        'dept': int(stu['dept']) if 'dept' in stu else 48,
+        'grade': int(stu['grade']) if 'grade' in stu else 2017,
+        'creditLimit': int(stu['credit_limit']) if 'credit_limit' in stu else 25,
+    }
+
+
+def existingUids(uids: list) -> set:
+    return set(AuthUser.objects.filter(username__in=uids).values_list('username', flat=True))
+
+
+# 插入一批已经哈希过密码的学生
+def insertChunk(stus: list):
+    if not stus:
+        return
+    parentFields = [f.attname for f in AuthUser._meta.concrete_fields if not f.primary_key]
+    childFields = User._meta.local_concrete_fields
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        connection.ops.quote_name(User._meta.db_table),
+        ', '.join(connection.ops.quote_name(f.column) for f in childFields),
+        ', '.join(['%s'] * len(childFields)))
+    with transaction.atomic():
+        AuthUser.objects.bulk_create(
+            [AuthUser(**{attr: getattr(u, attr) for attr in parentFields}) for u in stus])
+        # bulk_create does not return the ids on MySQL, read them back in one query
+        pks = dict(AuthUser.objects.filter(username__in=[u.username for u in stus]).values_list('username', 'pk'))
+        for u in stus:
+            u.id = u.user_ptr_id = pks[u.username]
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [[f.get_db_prep_save(getattr(u, f.attname), connection) for f in childFields]
+                                     for u in stus])
+
+
+def hashPasswords(executor, passwords: list) -> list:
+    if executor is None:
+        return [make_password(p) for p in passwords]
+    return list(executor.map(make_password, passwords, chunksize=16))
+
+
+# progress(已处理行数, 总行数)在每批插入后调用
+def importStudents(rows: list, workers: int = STU_IMPORT['WORKERS'],
+                   chunkSize: int = STU_IMPORT['CHUNK'], progress=None):
+    errors = []
+    valid = []
+    seen = set()
+    for idx, stu in enumerate(rows, 1):
+        try:
+            fields = parseRow(stu)
+        except (ValueError, TypeError):
+            logging.warn('Import row {} param error'.format(idx))
+            errors.append({'row': idx, 'uid': stu.get('uid') if isinstance(stu, dict) else None,
+                           'msg': ERR_TYPE.PARAM_ERR})
+            continue
+        if fields['username'] in seen:
+            errors.append({'row': idx, 'uid': fields['username'], 'msg': ERR_TYPE.USER_DUP})
+            continue
+        seen.add(fields['username'])
+        valid.append((idx, fields))
+
+    taken = existingUids(list(seen))
+    if taken:
+        logging.warn('{} students to import already exist'.format(len(taken)))
+        errors.extend({'row': idx, 'uid': fields['username'], 'msg': ERR_TYPE.USER_DUP}
+                      for idx, fields in valid if fields['username'] in taken)
+        valid = [(idx, fields) for idx, fields in valid if fields['username'] not in taken]
+
+    created = 0
+    # Starting the pool does not pay off for a handful of students
+    executor = None
+    if workers > 1 and len(valid) >= 2 * workers:
+        executor = getPool(workers)
+    for start in range(0, len(valid), chunkSize):
+        chunk = valid[start:start + chunkSize]
+        hashes = hashPasswords(executor, [fields['password'] for idx, fields in chunk])
+        stus = [User(**dict(fields, password=h)) for (idx, fields), h in zip(chunk, hashes)]
+        try:
+            insertChunk(stus)
+        except IntegrityError:
+            # Another import created some of the uids in the meantime
+            taken = existingUids([u.username for u in stus])
+            logging.error('Import chunk conflicts with {} existing students'.format(len(taken)))
+            errors.extend({'row': idx, 'uid': fields['username'], 'msg': ERR_TYPE.USER_DUP}
+                          for idx, fields in chunk if fields['username'] in taken)
+            stus = [u for u in stus if u.username not in taken]
+            try:
+                insertChunk(stus)
+            except IntegrityError:
+                logging.error('Import rows {}-{} failed'.format(chunk[0][0], chunk[-1][0]))
+                errors.extend({'row': idx, 'uid': fields['username'], 'msg': ERR_TYPE.UNKNOWN}
+                              for idx, fields in chunk if fields['username'] not in taken)
+                stus = []
+        created += len(stus)
+        if progress is not None:
+            progress(start + len(chunk), len(valid))
+
+    errors.sort(key=lambda e: e['row'])
+    logging.info('Imported {} students, {} rows failed'.format(created, len(errors)))
+    return created, errors
@@ -0,0 +1,41 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from elect_system.settings import STU_IMPORT
+from user.importer import readRows, importStudents
+
+
+# 从json或csv文件批量导入学生，输出进度和每行的错误
+class Command(BaseCommand):
+    help = 'Import students from a json or csv file (columns: uid,name,gender,dept,grade,password,credit_limit)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='A .json or .csv file')
+        parser.add_argument('--workers', type=int, default=STU_IMPORT['WORKERS'],
+                            help='Worker processes used to hash the passwords')
+        parser.add_argument('--chunk', type=int, default=STU_IMPORT['CHUNK'],
+                            help='Students inserted per transaction')
+        parser.add_argument('--report', help='Write the per-row error report to this json file')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = 'csv' if path.lower().endswith('.csv') else 'json'
+        try:
+            with open(path, encoding='utf-8-sig') as f:
+                rows = readRows(f.read(), fmt)
+        except (OSError, ValueError) as e:
+            raise CommandError('Cannot read {}: {}'.format(path, e))
+
+        startTime = time.time()
+
+        def progress(done, total):
+            self.stdout.write('{}/{} rows processed, {:.1f}s'.format(done, total, time.time() - startTime))
+
+        created, errors = importStudents(rows, options['workers'], options['chunk'], progress)
+        for e in errors:
+            self.stdout.write('row {row} uid={uid}: {msg}'.format(**e))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(errors, f, indent=2, ensure_ascii=False)
+        self.stdout.write('{} students imported, {} rows failed, {:.1f}s'.format(
+            created, len(errors), time.time() - startTime))
@@ -1,8 +1,11 @@
 from django.db import models
+from django.db.models import F
 from django.utils import timezone
 import django.contrib.auth.models
 import random
 from threading import Lock
+from zlib import crc32
+from elect_system.settings import STU_LOCK_STRIPES
 
 '''
 类Mesaage用于传递信息
@@ -10,14 +13,14 @@ from threading import Lock
     genTime：消息发送时间
     title：消息标题
     content：消息文本内容
-    hasRead：消息是否得到阅读
+    hasRead：消息是否得到阅读（建有索引，标记全部已读时按它筛选）
 '''
 
 class Message(models.Model):
     genTime = models.DateTimeField(null=False)
     title = models.CharField(max_length=256, null=False)
     content = models.CharField(max_length=8192, null=False) # Enough?
-    hasRead = models.BooleanField(default=False, null=True)
+    hasRead = models.BooleanField(default=False, null=True, db_index=True)
 
 '''
 类User即为用户类
@@ -27,12 +30,19 @@ class Message(models.Model):
     dept：用户所在的院系（默认为信息科学与技术学院）
     grade：用户所在的年级
     messages：消息列表，维护一个多对多的消息关系
+    unreadMsgNum：未读消息的数量，在推送消息和标记已读时与消息在同一事务中维护
 
     creditLimit：选课的学分限制(初始化为25学分)
     curCredit：当前已经选修的学分数量（初始化为0）
     willingpointLimit：意愿点的总数限制（初始化为99点意愿点）
-    curWp：当前已经使用的意愿点数（初始化为0）
+    curWp：当前已经使用的意愿点数（初始化为0），即已选上和待抽签课程的意愿点之和，
+           在选课、修改意愿点、退课以及抽签失败时与选课记录在同一事务中维护
     isLegal：验证uid是否合法
+    charge：在学分和意愿点上限内原子地增加已选学分和已用意愿点
+    addWp：在意愿点上限内原子地调整已用意愿点
+    refund：退还学分和意愿点
+    reconcileUnread：检查（并修正）未读消息计数
+    已选学分和已用意愿点只通过以上F()表达式的UPDATE修改，不读出后整行写回
     __str__：返回用户信息的字符串，用于后续的处理
 '''
 class User(django.contrib.auth.models.User):
@@ -41,22 +51,70 @@ class User(django.contrib.auth.models.User):
     dept = models.IntegerField(default=48)
     grade = models.IntegerField(default=2017)
     messages = models.ManyToManyField(Message)
+    unreadMsgNum = models.IntegerField(default=0)
 
     creditLimit = models.IntegerField(default=25)
     curCredit = models.IntegerField(default=0)
     willingpointLimit = models.IntegerField(default=99)
-    curWp = models.IntegerField(default=0)  # Not used
+    curWp = models.IntegerField(default=0)
 
     def isLegal(uid: str) -> bool:
         return User.objects.filter(username=uid)
 
+    # 条件UPDATE，超出creditLimit或willingpointLimit时不修改并返回False
+    def charge(stuPk: int, credit: int, wp: int) -> bool:
+        return User.objects.filter(
+            pk=stuPk, curCredit__lte=F('creditLimit') - credit,
+            curWp__lte=F('willingpointLimit') - wp).update(
+            curCredit=F('curCredit') + credit, curWp=F('curWp') + wp) == 1
+
+    # 退课、退出待抽签时调用，只修改curCredit和curWp两列
+    def refund(stuPk: int, credit: int, wp: int):
+        User.objects.filter(pk=stuPk).update(
+            curCredit=F('curCredit') - credit, curWp=F('curWp') - wp)
+
+    # 条件UPDATE，wp可以为负数，超出willingpointLimit时不修改并返回False
+    def addWp(stuPk: int, wp: int) -> bool:
+        return User.objects.filter(pk=stuPk, curWp__lte=F('willingpointLimit') - wp).update(
+            curWp=F('curWp') + wp) == 1
+
+    # 返回[(uid, 计数, 实际值)]，fix为True时修正
+    def reconcileUnread(fix: bool = False) -> list:
+        actual = dict(User.objects.filter(messages__hasRead=False).values_list('pk').annotate(
+            num=models.Count('messages')).order_by())
+        drift, stale = [], []
+        for u in User.objects.only('username', 'unreadMsgNum').iterator():
+            num = actual.get(u.pk, 0)
+            if u.unreadMsgNum != num:
+                drift.append((u.username, u.unreadMsgNum, num))
+                u.unreadMsgNum = num
+                stale.append(u)
+        if fix:
+            User.objects.bulk_update(stale, ['unreadMsgNum'], batch_size=1000)
+        return drift
+
     def __str__(self) -> str:
         return '<' + self.username + ',' + str(self.gender) + ',' + \
             str(self.dept) + ',' + str(self.grade) + str(self.creditLimit) + \
             str(self.willingpointLimit) + '>'
 
 
-stuLock = {}
+'''
+类StripedLock为学生的进程内锁表
+    固定数量的锁在创建时生成，学生按uid的哈希值映射到其中一把锁上，
+    不需要在启动时扫描用户表，新建的学生也立即可用，内存占用与学生数量无关。
+    不同的学生可能共用一把锁，只会偶尔多等待一次，不影响正确性。
+    get：返回uid对应的锁，接口与原来的dict相同
+'''
+class StripedLock:
+    def __init__(self, stripes: int):
+        self.locks = [Lock() for i in range(stripes)]
+
+    def get(self, uid: str) -> Lock:
+        return self.locks[crc32(str(uid).encode()) % len(self.locks)]
+
+
+stuLock = StripedLock(STU_LOCK_STRIPES)
 '''
     VerificationCode类用于验证码的验证
     getVerificationCode：获取验证码（验证码内置cd：30秒）
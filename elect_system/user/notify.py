@@ -0,0 +1,43 @@
+import logging
+import threading
+from django.core.cache import caches
+from elect_system.settings import NOTIFY
+
+'''
+消息和选课开放状态的变化通知
+
+推送消息或开放/关闭选课后调用notifyHub.publish()，版本号加一；
+长轮询接口（user/poll）在等待期间只比较版本号，版本号变化时才读取数据库。
+NOTIFY['CACHE']为None时版本号只在进程内有效，其他进程的变化由长轮询每隔
+NOTIFY['RECHECK']秒读取一次数据库发现；设置为django缓存的别名时版本号在各worker之间共享。
+'''
+
+VERSION_KEY = 'notify:version'
+
+
+class NotifyHub:
+    def __init__(self, alias: str = None):
+        self.alias = alias
+        self.lock = threading.Lock()
+        self.localVersion = 0
+
+    def shared(self):
+        if self.alias is None:
+            return None
+        return caches[self.alias]
+
+    def publish(self):
+        with self.lock:
+            self.localVersion += 1
+        shared = self.shared()
+        if shared is not None:
+            shared.add(VERSION_KEY, 0, None)
+            shared.incr(VERSION_KEY)
+        logging.debug('Notification published, local version {}'.format(self.localVersion))
+
+    def version(self) -> tuple:
+        shared = self.shared()
+        return self.localVersion, shared.get(VERSION_KEY, 0) if shared is not None else 0
+
+
+notifyHub = NotifyHub(NOTIFY['CACHE'])
@@ -1,8 +1,12 @@
 from django.http.response import JsonResponse
 from django.test import TestCase
-from .models import User
+from .models import User, Message
+from django.utils import timezone
 from elect_system.settings import ERR_TYPE
 import json
+import time
+import asyncio
+from asgiref.sync import sync_to_async
 #测试类，用于对user类的功能实现测试
 
 class UserTests(TestCase):
@@ -182,7 +186,8 @@ class UserTests(TestCase):
         resp = respData.json()
         self.assertEqual(resp.get('success'), True)
         self.assertEqual(type(resp.get('data')), list)
-        self.assertEqual(len(resp.get('data')), 3)
+        self.assertEqual(len(resp.get('data')), 2)
+        self.assertNotIn('jyeecs', [s.get('uid') for s in resp.get('data')])
 
         # 教务退出登录
         respData = self.client.post('/user/logout')
@@ -301,3 +306,212 @@ class UserTests(TestCase):
         resp = respData.json()
         self.assertEqual(resp.get('success'), False)
         self.assertEqual(resp.get('msg'), ERR_TYPE.AUTH_FAIL)
+
+    #消息列表的测试
+    def test_messages(self):
+        u = User.objects.create_user('1600013239', password='123456')
+        other = User.objects.create_user('1700012855', password='123456')
+        msgs = [Message.objects.create(title='抽签结果', content=str(i), genTime=timezone.now()) for i in range(3)]
+        u.messages.add(*msgs)
+        otherMsg = Message.objects.create(title='抽签结果', content='other', genTime=timezone.now())
+        other.messages.add(otherMsg)
+        User.objects.filter(pk=u.pk).update(unreadMsgNum=3)
+        User.objects.filter(pk=other.pk).update(unreadMsgNum=1)
+        self.assertEqual(User.reconcileUnread(), [])
+
+        respData = self.client.post(
+            '/user/login', json.dumps({'uid': '1600013239', 'password': '123456'}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+        # 不带limit时返回全部消息，从新到旧
+        resp = self.client.get('/user/message').json()
+        self.assertEqual(resp.get('unReadNum'), 3)
+        self.assertEqual([m.get('content') for m in resp.get('messages')], ['2', '1', '0'])
+
+        # 分页
+        resp = self.client.get('/user/message?limit=2').json()
+        self.assertEqual([m.get('content') for m in resp.get('messages')], ['2', '1'])
+        resp = self.client.get('/user/message?limit=2&cursor={}'.format(resp.get('next_cursor'))).json()
+        self.assertEqual([m.get('content') for m in resp.get('messages')], ['0'])
+        self.assertIsNone(resp.get('next_cursor'))
+        resp = self.client.get('/user/message?limit=0').json()
+        self.assertEqual(resp.get('msg'), ERR_TYPE.PARAM_ERR)
+
+        # 重复标记同一条消息只计一次，不能标记其他学生的消息
+        for i in range(2):
+            resp = self.client.post('/user/message/{}'.format(msgs[0].id)).json()
+            self.assertEqual(resp.get('success'), True)
+        self.assertEqual(self.client.get('/user/message').json().get('unReadNum'), 2)
+        resp = self.client.post('/user/message/{}'.format(otherMsg.id)).json()
+        self.assertEqual(resp.get('msg'), ERR_TYPE.MSG_404)
+
+        # 全部标记为已读
+        resp = self.client.post('/user/message/all').json()
+        self.assertEqual(resp.get('success'), True)
+        resp = self.client.get('/user/message').json()
+        self.assertEqual(resp.get('unReadNum'), 0)
+        self.assertTrue(all(m.get('hasRead') for m in resp.get('messages')))
+        self.assertFalse(Message.objects.get(id=otherMsg.id).hasRead)
+        self.assertEqual(User.reconcileUnread(), [])
+
+    def test_poll(self):
+        from phase.views import setElectionOpen, isElectionOpen
+        u = User.objects.create_user('1600013239', password='123456')
+        self.client.post(
+            '/user/login', json.dumps({'uid': '1600013239', 'password': '123456'}), content_type="application/json")
+
+        # 不带msg_cursor时立即返回当前状态
+        resp = self.client.get('/user/poll').json()
+        self.assertEqual(resp.get('success'), True)
+        self.assertEqual(resp.get('changed'), True)
+        self.assertIsNone(resp.get('latest_msg_id'))
+        self.assertEqual(resp.get('election_open'), True)
+
+        # 没有变化时等到超时
+        resp = self.client.get('/user/poll?msg_cursor=0&open=1&timeout=0.2').json()
+        self.assertEqual(resp.get('changed'), False)
+        self.assertIsNone(resp.get('messages'))
+
+        # 有比msg_cursor新的消息时立即返回
+        msg = Message.objects.create(title='抽签结果', content='0', genTime=timezone.now())
+        u.messages.add(msg)
+        User.objects.filter(pk=u.pk).update(unreadMsgNum=1)
+        resp = self.client.get('/user/poll?msg_cursor=0&timeout=5').json()
+        self.assertEqual(resp.get('changed'), True)
+        self.assertEqual(resp.get('unReadNum'), 1)
+        self.assertEqual(resp.get('latest_msg_id'), msg.id)
+        self.assertEqual([m.get('id') for m in resp.get('messages')], [msg.id])
+
+        # 选课开放状态的变化
+        try:
+            setElectionOpen(False)
+            self.assertFalse(isElectionOpen())
+            resp = self.client.get('/user/poll?msg_cursor={}&open=1&timeout=5'.format(msg.id)).json()
+            self.assertEqual(resp.get('changed'), True)
+            self.assertEqual(resp.get('election_open'), False)
+        finally:
+            setElectionOpen(True)
+
+        resp = self.client.get('/user/poll?timeout=x').json()
+        self.assertEqual(resp.get('msg'), ERR_TYPE.PARAM_ERR)
+
+    def test_import(self):
+        from user.importer import readRows, importStudents
+        User.objects.create_user('1600013239', password='123456')
+        content = 'uid,name,gender,dept,grade,password,credit_limit\n' + \
+            '1700000001,A,1,48,2017,123456,\n' + \
+            '1700000002,B,0,12,2018,123456,30\n' + \
+            '1700000001,C,1,48,2017,123456,\n' + \
+            '1600013239,D,1,48,2017,123456,\n' + \
+            '1700000003,E,1,x,2017,123456,\n' + \
+            ',F,1,48,2017,123456,\n' + \
+            '1700000004,G,,,,654321,\n'
+        progress = []
+        created, errors = importStudents(readRows(content, 'csv'), workers=2, chunkSize=2,
+                                         progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(created, 3)
+        self.assertEqual([(e['row'], e['msg']) for e in errors], [
+            (3, ERR_TYPE.USER_DUP), (4, ERR_TYPE.USER_DUP), (5, ERR_TYPE.PARAM_ERR), (6, ERR_TYPE.PARAM_ERR)])
+        self.assertEqual(progress, [(2, 3), (3, 3)])
+
+        b = User.objects.get(username='1700000002')
+        self.assertEqual((b.name, b.gender, b.dept, b.grade, b.creditLimit), ('B', False, 12, 2018, 30))
+        g = User.objects.get(username='1700000004')
+        self.assertEqual((g.gender, g.dept, g.grade, g.creditLimit, g.curCredit), (True, 48, 2017, 25, 0))
+        self.assertTrue(g.check_password('654321'))
+
+        # 不是uid重复的插入错误记入错误列表，不影响其他批次
+        from unittest import mock
+        from django.db import IntegrityError
+        with mock.patch('user.importer.insertChunk', side_effect=IntegrityError):
+            created, errors = importStudents([{'uid': '1700000005', 'password': '123456'}], workers=1)
+        self.assertEqual(created, 0)
+        self.assertEqual([(e['row'], e['msg']) for e in errors], [(1, ERR_TYPE.UNKNOWN)])
+
+        # 各次导入共用同一个进程池，导入结束后不关闭
+        from elect_system.pools import getPool
+        for batch in range(2):
+            rows = [{'uid': '17000001{}{}'.format(batch, i), 'password': '123456'} for i in range(4)]
+            self.assertEqual(importStudents(rows, workers=2), (4, []))
+            if batch == 0:
+                pool = getPool(2)
+        self.assertIs(getPool(2), pool)
+        self.assertEqual(pool.submit(int, '1').result(), 1)
+        self.assertTrue(User.objects.get(username='1700000113').check_password('123456'))
+
+        # 导入的学生可以正常登录
+        respData = self.client.post(
+            '/user/login', json.dumps({'uid': '1700000002', 'password': '123456'}), content_type="application/json")
+        self.assertEqual(respData.json().get('success'), True)
+
+    def test_roster(self):
+        import user.views
+        admin = User.objects.create_user('jyeecs', password='123456')
+        admin.is_superuser = True
+        admin.save()
+        for i in range(5):
+            User.objects.create_user('170000000{}'.format(i), password='123456', name='S{}'.format(i),
+                                     dept=48 if i % 2 == 0 else 12, grade=2017 + i % 3)
+        self.client.post(
+            '/user/login', json.dumps({'uid': 'jyeecs', 'password': '123456'}), content_type="application/json")
+
+        # 按院系、年级筛选
+        resp = self.client.get('/user/students?dept=48&grade=2019').json()
+        self.assertEqual([s.get('uid') for s in resp.get('data')], ['1700000002'])
+
+        # 分页
+        resp = self.client.get('/user/students?grade=2017&limit=2').json()
+        self.assertEqual([s.get('uid') for s in resp.get('data')], ['1700000000', '1700000003'])
+        resp = self.client.get('/user/students?grade=2017&limit=2&cursor={}'.format(resp.get('next_cursor'))).json()
+        self.assertEqual(resp.get('data'), [])
+        self.assertIsNone(resp.get('next_cursor'))
+        resp = self.client.get('/user/students?grade=x').json()
+        self.assertEqual(resp.get('msg'), ERR_TYPE.PARAM_ERR)
+
+        # 流式导出，每批读取的学生数量不影响结果
+        chunk = user.views.STU_STREAM_CHUNK
+        try:
+            user.views.STU_STREAM_CHUNK = 2
+            respData = self.client.get('/user/students?format=jsonl')
+            rows = [json.loads(line) for line in b''.join(respData.streaming_content).decode().splitlines()]
+            # 教务帐户不在导出的名单中
+            self.assertEqual([s.get('uid') for s in rows], ['170000000{}'.format(i) for i in range(5)])
+            self.assertEqual(rows[1].get('dept'), 12)
+
+            respData = self.client.get('/user/students?format=csv&dept=12')
+            lines = b''.join(respData.streaming_content).decode().splitlines()
+            self.assertEqual(lines[0].split(',')[:2], ['uid', 'name'])
+            self.assertEqual([line.split(',')[0] for line in lines[1:]], ['1700000001', '1700000003'])
+        finally:
+            user.views.STU_STREAM_CHUNK = chunk
+        resp = self.client.get('/user/students?format=xml').json()
+        self.assertEqual(resp.get('msg'), ERR_TYPE.PARAM_ERR)
+
+        # 学生不能导出
+        self.client.post('/user/logout')
+        self.client.post(
+            '/user/login', json.dumps({'uid': '1700000000', 'password': '123456'}), content_type="application/json")
+        resp = self.client.get('/user/students?format=csv').json()
+        self.assertEqual(resp.get('msg'), ERR_TYPE.NOT_ALLOWED)
+
+    async def test_poll_concurrent(self):
+        # ASGI下等待中的长轮询不占用线程，不阻塞其他请求
+        def login():
+            User.objects.create_user('1600013239', password='123456')
+            self.client.post(
+                '/user/login', json.dumps({'uid': '1600013239', 'password': '123456'}), content_type="application/json")
+        await sync_to_async(login)()
+        self.async_client.cookies = self.client.cookies
+
+        pollTask = asyncio.ensure_future(self.async_client.get('/user/poll?msg_cursor=0&timeout=2'))
+        await asyncio.sleep(0.3)
+        startTime = time.time()
+        resp = await self.async_client.get('/user/test')
+        self.assertLess(time.time() - startTime, 1)
+        self.assertEqual(resp.json().get('success'), True)
+        # 准入控制的接口在事件循环中申请名额
+        resp = await self.async_client.get('/course/courses')
+        self.assertEqual(resp.json().get('success'), True)
+        self.assertFalse(pollTask.done())
+        resp = await pollTask
+        self.assertEqual(resp.json().get('changed'), False)
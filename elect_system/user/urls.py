@@ -13,5 +13,6 @@ urlpatterns = [
     re_path(r'students/(\w{0,})', views.students),
     path('message', views.message),
     re_path(r'message/(\w{0,})', views.message),
+    path('poll', views.poll),
     path('test', views.test),
 ]
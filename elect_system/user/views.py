@@ -1,26 +1,31 @@
 from django.core.mail import send_mail
-from django.http import HttpResponse, JsonResponse, HttpRequest
+from django.http import HttpResponse, JsonResponse, HttpRequest, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+import csv
 import json
 import traceback
 import logging
 import time
+import asyncio
 import django.contrib.auth as auth
-from .models import User, VerificationCode, stuLock, Message
-from elect_system.settings import ERR_TYPE
-from threading import Lock
+from .models import User, VerificationCode, Message
+from elect_system.settings import ERR_TYPE, NOTIFY
+from django.db import transaction
+from django.db.models import F, Max
+from asgiref.sync import sync_to_async
+from phase.views import isElectionOpen
+from .notify import notifyHub
+from .importer import readRows, importStudents
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Max page size of the message inbox
+MSG_PAGE_MAX = 100
+# Max page size of the student list, and students read per query by the export
+STU_PAGE_MAX = 500
+STU_STREAM_CHUNK = 2000
 
-def init():
-    userSet = User.objects.all()
-    for u in userSet:
-        stuLock[u.username] = Lock()
-
-
-init()
 
 #返回关于选课的JsonResponse：coming soon
 @csrf_exempt
@@ -198,7 +203,7 @@ def password(request: HttpRequest, uid: str = ''):
             })
 
         v.user.set_password(passwd)
-        v.user.save()
+        v.user.save(update_fields=['password'])
         v.delete()
         return JsonResponse({'success': True})
 
@@ -207,6 +212,67 @@ def password(request: HttpRequest, uid: str = ''):
         return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
 
 
+# 学生信息只读取这些列
+STU_COLUMNS = ('id', 'username', 'name', 'gender', 'dept', 'grade', 'creditLimit', 'curCredit', 'curWp')
+STU_CSV_HEADER = ['uid', 'name', 'gender', 'dept', 'grade', 'creditLimit', 'curCredit', 'curWillingpoint']
+
+
+def student_json(row: dict) -> dict:
+    return {
+        'uid': row['username'],
+        'name': row['name'],
+        'gender': row['gender'],
+        'dept': row['dept'],
+        'grade': row['grade'],
+        'creditLimit': row['creditLimit'],
+        'curCredit': row['curCredit'],
+        'curWillingpoint': row['curWp'],
+    }
+
+#按主键进行keyset分页，cursor为上一页最后一个学生的主键（next_cursor）
+def student_page(userSet, cursor: int, limit: int) -> list:
+    userSet = userSet.order_by('pk')
+    if cursor:
+        userSet = userSet.filter(pk__gt=cursor)
+    return list(userSet.values(*STU_COLUMNS)[:limit])
+
+#逐批读取学生，每次只在内存中保留一批
+#（MySQL的默认游标会把iterator()的整个结果集读到客户端，这里与课程的流式导出一样按主键分批）
+def iter_students(userSet):
+    cursor = None
+    while True:
+        page = student_page(userSet, cursor, STU_STREAM_CHUNK)
+        for row in page:
+            yield student_json(row)
+        if len(page) < STU_STREAM_CHUNK:
+            break
+        cursor = page[-1]['id']
+
+
+def stream_students_jsonl(userSet):
+    for stu in iter_students(userSet):
+        yield json.dumps(stu, ensure_ascii=False) + '\n'
+
+
+class EchoBuffer:
+    def write(self, value):
+        return value
+
+
+def stream_students_csv(userSet):
+    writer = csv.writer(EchoBuffer())
+    yield writer.writerow(STU_CSV_HEADER)
+    for stu in iter_students(userSet):
+        yield writer.writerow([stu[key] for key in STU_CSV_HEADER])
+
+
+# format参数 -> (生成器, Content-Type)
+STU_EXPORT_FORMATS = {
+    'jsonl': (stream_students_jsonl, 'application/x-ndjson'),
+    'csv': (stream_students_csv, 'text/csv'),
+}
+
+
 # NOTE: 事实上，学生帐户和教务帐户都可以通过这种方法访问
 @csrf_exempt
 def students(request: HttpRequest, uid: str = ''):
@@ -219,66 +285,22 @@ def students(request: HttpRequest, uid: str = ''):
                 'success': False,
                 'msg': ERR_TYPE.NOT_ALLOWED,
             })
+        # 支持json（{'students': [...]}）和csv（Content-Type为text/csv）两种格式
+        fmt = 'csv' if request.content_type == 'text/csv' else 'json'
         try:
-            reqData = json.loads(request.body.decode())
-        except:
-            traceback.print_exc()
+            stus = readRows(request.body.decode(), fmt)
+        except json.JSONDecodeError:
             logging.error('Json format error, req.body={}'.format(
                 request.body.decode()))
             return JsonResponse({'success': False, 'msg': ERR_TYPE.JSON_ERR})
-        stus = reqData.get('students')
-        if not isinstance(stus, list):
+        except:
             logging.error('no students list')
             return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
 
-        for stu in stus:
-            uid = stu.get('uid')
-            stuName = stu.get('name')
-            stuGender = stu.get('gender')
-            stuDept = stu.get('dept')
-            stuGrade = stu.get('grade')
-            stuPasswd = stu.get('password')
-            stuCreditLimit = stu.get('credit_limit')
-
-            try:
-                if stuDept:
-                    stuDept = int(stuDept)
-                if stuGrade:
-                    stuGrade = int(stuGrade)
-                if stuGender:
-                    stuGender = bool(stuGender)
-                else:
-                    stuGender = True
-                if stuCreditLimit:
-                    stuCreditLimit = int(stuCreditLimit)
-                else:
-                    stuCreditLimit = 25
-            except:
-                traceback.print_exc()
-                logging.warn('Param type error, type(stuDept)={}, type(stuGrade)={}, type(stuGender)={}'.format(
-                    type(stuDept), type(stuGrade), type(stuGender)))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-
-            if uid is None or stuPasswd is None:
-                logging.warn('Missing uid or passwd')
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
-            if User.objects.filter(username=uid).exists():    # User already exists
-                logging.warn('User uid={} already exists'.format(uid))
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.USER_DUP})
-            try:
-                u = User.objects.create_user(
-                    username=uid, name=stuName, gender=stuGender,
-                    dept=stuDept, grade=stuGrade, password=stuPasswd,
-                    creditLimit=stuCreditLimit
-                )
-                u.save()
-                stuLock[u.username] = Lock()
-            except:
-                traceback.print_exc()
-                logging.error("Unknown error 15213")
-                return JsonResponse({'success': False, 'msg': ERR_TYPE.UNKNOWN})
-
-        return JsonResponse({'success': True})
+        created, errors = importStudents(stus)
+        if errors:
+            return JsonResponse({'success': False, 'msg': errors[0]['msg'], 'created': created, 'errors': errors})
+        return JsonResponse({'success': True, 'created': created})
 
     # Retrive user info
     # 学生不能够查看其他学生的个人信息，教务可以获取学生的信息列表
@@ -291,29 +313,45 @@ def students(request: HttpRequest, uid: str = ''):
                 'success': False,
                 'msg': ERR_TYPE.NOT_ALLOWED,
             })
-        userSet = {}
-        if uid == '':
-            userSet = User.objects.filter()
-        else:
-            userSet = User.objects.filter(username=uid)
-        if not userSet.exists():
-            return JsonResponse({'success': True, 'data': []})
-        userList = []
-        for idx in range(0, userSet.count()):
-            user = userSet[idx]
-            userDict = {
-                'uid': user.username,
-                'name': user.name,
-                'gender': user.gender,
-                'dept': user.dept,
-                'grade': user.grade,
-                'creditLimit': user.creditLimit,
-                'curCredit': user.curCredit,
-                # 'willingpointLimit': user.willingpointLimit,
-                'curWillingpoint': user.curWp    # This field is not used
-            }
-            userList.append(userDict)
-        return JsonResponse({'success': True, 'data': userList})
+        # 教务的学生列表支持按院系、年级筛选，分页（limit、cursor）以及流式导出（format=jsonl/csv）
+        dept = request.GET.get('dept')
+        grade = request.GET.get('grade')
+        limit = request.GET.get('limit')
+        cursor = request.GET.get('cursor')
+        fmt = request.GET.get('format')
+        try:
+            if limit:
+                limit = min(int(limit), STU_PAGE_MAX)
+                if limit <= 0:
+                    raise ValueError('Invalid limit {}'.format(limit))
+            if fmt and fmt not in STU_EXPORT_FORMATS:
+                raise ValueError('Invalid format {}'.format(fmt))
+            # 教务帐户不属于学生名单
+            userSet = User.objects.filter(is_superuser=False)
+            if uid != '':
+                userSet = userSet.filter(username=uid)
+            if dept:
+                userSet = userSet.filter(dept=int(dept))
+            if grade:
+                userSet = userSet.filter(grade=int(grade))
+            cursor = int(cursor) if cursor else None
+        except:
+            logging.error('Student list param err, query={}'.format(request.GET.dict()))
+            return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
+
+        if fmt:
+            response = StreamingHttpResponse(STU_EXPORT_FORMATS[fmt][0](userSet),
+                                             content_type=STU_EXPORT_FORMATS[fmt][1])
+            response['Content-Disposition'] = 'attachment; filename="students.{}"'.format(fmt)
+            return response
+        if limit:
+            page = student_page(userSet, cursor, limit)
+            return JsonResponse({
+                'success': True,
+                'data': [student_json(row) for row in page],
+                'next_cursor': page[-1]['id'] if len(page) == limit else None,
+            })
+        return JsonResponse({'success': True, 'data': [student_json(row) for row in userSet.values(*STU_COLUMNS)]})
 
     # 编辑学生的个人信息，使用PUT的方式来传递参数（需要处理对不同信息的编辑处理请求）
     elif request.method == 'PUT':
@@ -367,19 +405,29 @@ def students(request: HttpRequest, uid: str = ''):
             logging.warn('Edit user param type error')
             return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
 
+        # Only the edited columns are written, curCredit/curWp are maintained
+        # by the elect endpoint with F() updates and must not be overwritten
+        fields = []
         if name:
             user.name = name
+            fields.append('name')
         if dept:
             user.dept = dept
+            fields.append('dept')
         if gender:
             user.gender = gender
+            fields.append('gender')
         if grade:
             user.grade = grade
+            fields.append('grade')
         if creditLimit:
             user.creditLimit = creditLimit
-        if password:
+            fields.append('creditLimit')
+        if passwd:
             user.set_password(passwd)
-        user.save()
+            fields.append('password')
+        if fields:
+            user.save(update_fields=fields)
         return JsonResponse({'success': True})
 
     # 删除一个用户
@@ -398,6 +446,15 @@ def students(request: HttpRequest, uid: str = ''):
     else:
         return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
 
+def messageJson(msg: Message) -> dict:
+    return {
+        'id': msg.id,
+        'time': int(msg.genTime.timestamp())*1000,
+        'title': msg.title,
+        'content': msg.content,
+        'hasRead': msg.hasRead
+    }
+
 #发送信息函数
 @csrf_exempt
 def message(request: HttpRequest, mid=''):
@@ -415,12 +472,13 @@ def message(request: HttpRequest, mid=''):
         if request.user.is_superuser:
             return JsonResponse({'success': True})
 
+        # Only unread messages are updated, the unread counter follows the
+        # number of rows actually changed
+        stuPk = request.user.pk
         if mid == 'all':
-            u = User.objects.filter(username=request.user.username).get()
-            userMsgSet = u.messages.all()
-            for msg in userMsgSet:
-                msg.hasRead = True
-                msg.save()
+            with transaction.atomic():
+                Message.objects.filter(user=stuPk, hasRead=False).update(hasRead=True)
+                User.objects.filter(pk=stuPk).update(unreadMsgNum=0)
         else:
             try:
                 mid = int(mid)
@@ -430,39 +488,106 @@ def message(request: HttpRequest, mid=''):
                     'Read msg param error, id={}'.format(mid))
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
 
-            msgSet = Message.objects.filter(id=mid)
+            msgSet = Message.objects.filter(id=mid, user=stuPk)
             if not msgSet.exists():
                 logging.error('Read a nonexistent message, id={}'.format(mid))
                 return JsonResponse({'success': False, 'msg': ERR_TYPE.MSG_404})
-            msg = msgSet.get()
-            msg.hasRead = True
-            msg.save()
+            with transaction.atomic():
+                if msgSet.filter(hasRead=False).update(hasRead=True):
+                    User.objects.filter(pk=stuPk).update(unreadMsgNum=F('unreadMsgNum') - 1)
         return JsonResponse({'success': True})
 
-    # 获取消息列表
+    # 获取消息列表，按时间从新到旧排列
+    # 带limit参数时分页返回，cursor为上一页最后一条消息的id
     elif request.method == 'GET':
         # Note：由于教务和学生不是同一类用户，为了简化工作这里实际上没有为教务设计消息列表
         if request.user.is_superuser:
             return JsonResponse({'success': True, 'messages': []})
 
-        uSet = User.objects.filter(username=request.user.username)
-        u = uSet.get()
-        msgList = []
-        userMsgSet = u.messages.all()
-        unReadCnt = 0
-        for msg in userMsgSet:
-            msgDict = {
-                'id': msg.id,
-                'time': int(msg.genTime.timestamp())*1000,
-                'title': msg.title,
-                'content': msg.content,
-                'hasRead': msg.hasRead
-            }
-            msgList.append(msgDict)
-            if not msg.hasRead:
-                unReadCnt += 1
-        return JsonResponse({'success': True, 'unReadNum': unReadCnt, 'messages': msgList})
+        limit = request.GET.get('limit')
+        cursor = request.GET.get('cursor')
+        try:
+            if limit:
+                limit = min(int(limit), MSG_PAGE_MAX)
+                if limit <= 0:
+                    raise ValueError('Invalid limit {}'.format(limit))
+            if cursor:
+                cursor = int(cursor)
+        except:
+            logging.error('Message param err, limit={}, cursor={}'.format(limit, cursor))
+            return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
+
+        unReadCnt = User.objects.filter(pk=request.user.pk).values_list('unreadMsgNum', flat=True).first()
+        if unReadCnt is None:
+            return JsonResponse({'success': False, 'msg': ERR_TYPE.USER_404})
+
+        msgSet = Message.objects.filter(user=request.user.pk).order_by('-id')
+        if cursor:
+            msgSet = msgSet.filter(id__lt=cursor)
+        if limit:
+            msgSet = msgSet[:limit]
+        msgList = [messageJson(msg) for msg in msgSet]
+        retDict = {'success': True, 'unReadNum': unReadCnt, 'messages': msgList}
+        if limit:
+            retDict['next_cursor'] = msgList[-1]['id'] if len(msgList) == limit else None
+        return JsonResponse(retDict)
 
     else:
         logging.error(ERR_TYPE.INVALID_METHOD)
         return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
+
+
+#长轮询的当前状态：未读消息数、最新消息的id以及选课是否开放，一次查询
+def pollState(stuPk: int) -> dict:
+    unread, latest = User.objects.filter(pk=stuPk).annotate(
+        latest=Max('messages__id')).values_list('unreadMsgNum', 'latest').get()
+    return {'unReadNum': unread, 'latest_msg_id': latest, 'election_open': isElectionOpen()}
+
+
+def newMessages(stuPk: int, msgCursor: int) -> list:
+    msgSet = Message.objects.filter(user=stuPk, id__gt=msgCursor).order_by('-id')[:MSG_PAGE_MAX]
+    return [messageJson(msg) for msg in msgSet]
+
+
+#长轮询，等待新消息或选课开放状态的变化，代替前端对message接口的定时查询
+#   msg_cursor：客户端已有的最新消息id，不带时立即返回当前状态
+#   open：客户端已知的选课开放状态（0/1）
+#   timeout：最长等待的秒数，不超过NOTIFY['TIMEOUT']
+#等待期间只比较notifyHub的版本号，不占用数据库连接
+async def poll(request: HttpRequest):
+    if request.method != 'GET':
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.INVALID_METHOD})
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None or user.is_superuser:
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.NOT_ALLOWED})
+
+    try:
+        msgCursor = request.GET.get('msg_cursor')
+        msgCursor = int(msgCursor) if msgCursor else None
+        knownOpen = request.GET.get('open')
+        knownOpen = bool(int(knownOpen)) if knownOpen else None
+        timeout = min(float(request.GET.get('timeout', NOTIFY['TIMEOUT'])), NOTIFY['TIMEOUT'])
+    except:
+        logging.error('Poll param err, query={}'.format(request.GET.dict()))
+        return JsonResponse({'success': False, 'msg': ERR_TYPE.PARAM_ERR})
+
+    deadline = time.time() + timeout
+    while True:
+        version = notifyHub.version()
+        lastCheck = time.time()
+        state = await sync_to_async(pollState)(user.pk)
+        hasNewMsg = msgCursor is not None and (state['latest_msg_id'] or 0) > msgCursor
+        changed = msgCursor is None or hasNewMsg or \
+            (knownOpen is not None and knownOpen != state['election_open'])
+        if changed or lastCheck >= deadline:
+            break
+        while notifyHub.version() == version and time.time() < min(deadline, lastCheck + NOTIFY['RECHECK']):
+            await asyncio.sleep(NOTIFY['INTERVAL'])
+        if notifyHub.version() == version and time.time() >= deadline:
+            break
+
+    retDict = {'success': True, 'changed': changed}
+    retDict.update(state)
+    if hasNewMsg:
+        retDict['messages'] = await sync_to_async(newMessages)(user.pk, msgCursor)
+    return JsonResponse(retDict)